@@ -1,93 +1,1142 @@
 import base64
 import json
+import multiprocessing
 import requests
 import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
 from datetime import datetime, timedelta
 import argparse
+from array import array
+from bisect import bisect_right
+
+import numpy as np
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 DATE_TIME_FMT = "%Y-%m-%dT%H:%M:%S.%f"
-DEX_MSGS = ["MsgPlaceOrder"]
-parser = argparse.ArgumentParser()
-parser.add_argument("--node", default="localhost", help="Node base URL")
-args = parser.parse_args()
-node_base_url = args.node
-
-def get_block_height(tx_hash_str):
-    res = requests.get(f"http://{node_base_url}:1317/txs/{tx_hash_str}")
-    body = res.json()
-    if "height" not in body:
-        return
-    height = int(body["height"])
-    return height
+EVM_MSG_TYPE = "/seiprotocol.seichain.evm.MsgEVMTransaction"
+WASM_EXECUTE_MSG_TYPE = "/cosmwasm.wasm.v1.MsgExecuteContract"
+# Label of txs whose bytes are not a protobuf TxRaw
+UNDECODABLE = "undecodable"
+# Version segments of proto package names, e.g. the v1beta1 of /cosmos.bank.v1beta1.MsgSend
+PROTO_VERSION = re.compile(r"^v\d+((alpha|beta)\d*)?$")
+RPC_PORT = 26657
+# HTTP statuses worth retrying; anything else (e.g. 404 for an unknown tx) is an answer
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# Minimum seconds between two progress lines
+PROGRESS_INTERVAL = 1.0
+# Number of most recent tx hashes remembered to skip duplicates; older repeats cost one extra lookup
+TX_HASH_DEDUP_WINDOW = 100_000
+# Unix timestamps above these are taken to be in nanoseconds, microseconds and milliseconds
+SUBMIT_TIME_SCALES = ((1e17, 1e9), (1e14, 1e6), (1e11, 1e3))
+EPOCH = datetime(1970, 1, 1)
+# Number of lines read from each end of the tx hash file to bound the run in range mode
+TX_HASH_EDGE_LINES = 1000
+# Percentiles reported for every per-block series
+PERCENTILES = (50, 90, 99)
+# Seconds to wait before reconnecting a dropped websocket in --live mode
+LIVE_RECONNECT_SECONDS = 2
+# Bumped whenever rows written by an older metrics.py would be incomplete
+BLOCK_CACHE_VERSION = "3"
+# Kinds of per-block counts kept in block_messages, in the order decode_block_txs returns them
+BREAKDOWN_KINDS = ("module", "message", "size")
+# Share of a block limit from which a block counts as full
+FULL_BLOCK_THRESHOLD = 0.9
+# block_id_flag of commit signatures, which older nodes encode by name
+BLOCK_ID_FLAG_ABSENT, BLOCK_ID_FLAG_COMMIT, BLOCK_ID_FLAG_NIL = 1, 2, 3
+BLOCK_ID_FLAGS = {"BLOCK_ID_FLAG_ABSENT": 1, "BLOCK_ID_FLAG_COMMIT": 2, "BLOCK_ID_FLAG_NIL": 3}
+# Validators per /validators page, the most Tendermint returns
+VALIDATORS_PAGE_SIZE = 100
+# Number of most often absent validators reported
+TOP_ABSENT_VALIDATORS = 10
+# Schema of the local block cache, one SQLite database per chain id
+BLOCK_CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS headers (
+    height INTEGER PRIMARY KEY,
+    time TEXT NOT NULL,
+    num_txs INTEGER NOT NULL,
+    block_size INTEGER,
+    validators_hash TEXT
+);
+CREATE TABLE IF NOT EXISTS tx_heights (hash BLOB PRIMARY KEY, height INTEGER NOT NULL) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS decoded_blocks (height INTEGER PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS block_results (
+    height INTEGER PRIMARY KEY,
+    num_txs INTEGER NOT NULL,
+    gas_used INTEGER NOT NULL,
+    gas_wanted INTEGER NOT NULL,
+    failed_txs INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS consensus_params (
+    height INTEGER PRIMARY KEY,
+    max_bytes INTEGER NOT NULL,
+    max_gas INTEGER NOT NULL,
+    max_gas_wanted INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS commits (
+    height INTEGER PRIMARY KEY,
+    round INTEGER NOT NULL,
+    signatures INTEGER NOT NULL,
+    signed INTEGER NOT NULL,
+    absent INTEGER NOT NULL,
+    nil_votes INTEGER NOT NULL,
+    participation REAL NOT NULL,
+    absent_validators TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS block_messages (
+    height INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    name TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (height, kind, name)
+) WITHOUT ROWID;
+"""
+# Tendermint returns at most this many block metas per /blockchain call
+BLOCKCHAIN_PAGE_SIZE = 20
+# Marks the end of the input of NodeClient.fetch_all
+_END = object()
 
-def get_all_heights():
-    seen_heights = set([])
+
+class OfflineError(RuntimeError):
+    pass
+
+
+class NodeClient:
+    """
+    Talks to a node's Tendermint RPC endpoint. Every worker thread keeps its own keep-alive
+    session; failed requests are retried with backoff and bounded by a timeout. An offline
+    client refuses every request, so anything missing from the block cache is reported.
+    """
+
+    def __init__(self, host, concurrency, timeout, retries, offline=False):
+        self.host = host
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.retries = retries
+        self.offline = offline
+        self._local = threading.local()
+
+    def _check_online(self, path):
+        if self.offline:
+            raise OfflineError(f"{path} is not in the block cache and --offline is set")
+
+    def _session(self):
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = requests.Session()
+            retry = Retry(total=self.retries, backoff_factor=0.2, status_forcelist=RETRY_STATUSES, allowed_methods=None)
+            session.mount("http://", HTTPAdapter(max_retries=retry, pool_connections=2, pool_maxsize=2))
+            self._local.session = session
+        return session
+
+    def get_json(self, port, path):
+        self._check_online(path)
+        res = self._session().get(f"http://{self.host}:{port}{path}", timeout=self.timeout)
+        return res.json()
+
+    def post_json(self, port, path, payload):
+        self._check_online(path)
+        res = self._session().post(f"http://{self.host}:{port}{path}", json=payload, timeout=self.timeout)
+        return res.json()
+
+    def fetch_all(self, fn, items, what, total=None):
+        """
+        Calls fn on every item with at most `concurrency` requests in flight and yields
+        (item, result) in completion order. Items are pulled lazily, so a long input
+        stream is never held in memory as pending futures. Progress goes to stderr.
+        """
+        progress = Progress(what, total)
+        items = iter(items)
+        with ThreadPoolExecutor(self.concurrency) as executor:
+            in_flight = {}
+            exhausted = False
+            while in_flight or not exhausted:
+                while not exhausted and len(in_flight) < 2 * self.concurrency:
+                    item = next(items, _END)
+                    if item is _END:
+                        exhausted = True
+                    else:
+                        in_flight[executor.submit(fn, item)] = item
+                if not in_flight:
+                    break
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield in_flight.pop(future), future.result()
+                    progress.update()
+        progress.finish()
+
+
+class BlockStore:
+    """
+    Blocks seen during a run, keyed by height. Block time and tx count come from header
+    metadata fetched in ranges through /blockchain; full blocks are only downloaded when
+    their txs are needed, and not kept since every block's txs are read once.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.cache = None
+        self.downloads = 0
+        self.header_requests = 0
+        self._infos = {}
+        self._lock = threading.Lock()
+
+    def block(self, height):
+        """
+        Downloads the full block at height.
+        """
+        block = self.client.get_json(RPC_PORT, f"/block?height={height}")["block"]
+        with self._lock:
+            self.downloads += 1
+            # Header metadata from /blockchain also knows the block size, so keep it if loaded
+            self._infos.setdefault(height, parse_block_info(height, block))
+        return block
+
+    def info(self, height):
+        with self._lock:
+            info = self._infos.get(height)
+        if info is None:
+            self.load_headers([height])
+            with self._lock:
+                info = self._infos[height]
+        return info
+
+    def has_info(self, height):
+        with self._lock:
+            return height in self._infos
+
+    def load_headers(self, heights):
+        """
+        Fetches header metadata of every height not seen yet. Heights are grouped into
+        windows of one /blockchain page, which are requested concurrently.
+        """
+        missing = sorted(height for height in set(heights) if not self.has_info(height))
+        if self.cache is not None and missing:
+            cached = self.cache.load_infos(missing)
+            with self._lock:
+                self._infos.update(cached)
+            missing = [height for height in missing if height not in cached]
+        windows = []
+        for height in missing:
+            if windows and height <= windows[-1][0] + BLOCKCHAIN_PAGE_SIZE - 1:
+                windows[-1][1] = height
+            else:
+                windows.append([height, height])
+        if not windows:
+            return
+        for _ in self.client.fetch_all(self._load_header_range, windows, "header ranges fetched", total=len(windows)):
+            pass
+
+    def _load_header_range(self, window):
+        min_height, max_height = window
+        while min_height <= max_height:
+            body = self.client.get_json(RPC_PORT, f"/blockchain?minHeight={min_height}&maxHeight={max_height}")
+            metas = body["block_metas"]
+            infos = [parse_block_meta(int(meta["header"]["height"]), meta) for meta in metas]
+            with self._lock:
+                self.header_requests += 1
+                for info in infos:
+                    self._infos[info["height"]] = info
+            if self.cache is not None:
+                self.cache.store_infos(infos)
+            if not metas:
+                return
+            # Metas come newest first; the node may cap a page below what was asked for
+            max_height = min(int(meta["header"]["height"]) for meta in metas) - 1
+
+
+class BlockCache:
+    """
+    Header metadata, tx heights and decoded message types of one chain kept in a local SQLite
+    database, so analysing the same blocks again does not touch the node. Rows are only ever
+    added for the heights a run looked at, so the cache grows by height range run after run.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._db:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.executescript(BLOCK_CACHE_SCHEMA)
+            if self._get_meta("version") != BLOCK_CACHE_VERSION:
+                self._clear()
+                self._set_meta("version", BLOCK_CACHE_VERSION)
+
+    def _get_meta(self, key):
+        row = self._db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def _set_meta(self, key, value):
+        self._db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def _clear(self):
+        for table in ("headers", "tx_heights", "decoded_blocks", "block_messages", "block_results", "consensus_params",
+                      "commits"):
+            self._db.execute(f"DELETE FROM {table}")
+
+    def check_chain(self, earliest_block_hash):
+        """
+        Drops everything cached when the chain was reset under the same chain id, which is
+        noticed by its earliest block changing.
+        """
+        with self._lock, self._db:
+            cached_hash = self._get_meta("earliest_block_hash")
+            if cached_hash is not None and cached_hash != earliest_block_hash:
+                print(f"chain was reset, clearing block cache {self.path}", file=sys.stderr)
+                self._clear()
+            self._set_meta("earliest_block_hash", earliest_block_hash)
+
+    def load_infos(self, heights):
+        wanted = set(heights)
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT height, time, num_txs, block_size, validators_hash FROM headers WHERE height BETWEEN ? AND ?",
+                (min(wanted), max(wanted)),
+            ).fetchall()
+        return {
+            height: {
+                "height": height,
+                "timestamp": datetime.fromisoformat(timestamp),
+                "number_of_txs": num_txs,
+                "block_size": block_size,
+                "validators_hash": validators_hash,
+            }
+            for height, timestamp, num_txs, block_size, validators_hash in rows if height in wanted
+        }
+
+    def store_infos(self, infos):
+        rows = [
+            (info["height"], info["timestamp"].isoformat(), info["number_of_txs"], info.get("block_size"),
+             info.get("validators_hash"))
+            for info in infos
+        ]
+        with self._lock, self._db:
+            self._db.executemany("INSERT OR REPLACE INTO headers VALUES (?, ?, ?, ?, ?)", rows)
+
+    def load_tx_heights(self, tx_hashes):
+        keys = {tx_hash_key(tx_hash): tx_hash for tx_hash in tx_hashes}
+        key_list = list(keys)
+        rows = []
+        with self._lock:
+            # Stay below SQLite's limit on the number of query parameters
+            for i in range(0, len(key_list), 500):
+                chunk = key_list[i:i + 500]
+                rows += self._db.execute(
+                    f"SELECT hash, height FROM tx_heights WHERE hash IN ({','.join('?' * len(chunk))})", chunk
+                ).fetchall()
+        return {keys[key]: height for key, height in rows}
+
+    def store_tx_heights(self, resolved):
+        rows = [(tx_hash_key(tx_hash), height) for tx_hash, height in resolved]
+        with self._lock, self._db:
+            self._db.executemany("INSERT OR REPLACE INTO tx_heights VALUES (?, ?)", rows)
+
+    def load_breakdowns(self, heights):
+        """
+        Returns {height: (tx modules, message types, tx sizes)} of the decoded blocks among heights.
+        """
+        wanted = set(heights)
+        with self._lock:
+            decoded = self._db.execute(
+                "SELECT height FROM decoded_blocks WHERE height BETWEEN ? AND ?", (min(wanted), max(wanted))
+            ).fetchall()
+            rows = self._db.execute(
+                "SELECT height, kind, name, count FROM block_messages WHERE height BETWEEN ? AND ?",
+                (min(wanted), max(wanted)),
+            ).fetchall()
+        breakdowns = {height: tuple(Counter() for _ in BREAKDOWN_KINDS) for (height,) in decoded if height in wanted}
+        for height, kind, name, count in rows:
+            if height in breakdowns:
+                breakdowns[height][BREAKDOWN_KINDS.index(kind)][int(name) if kind == "size" else name] = count
+        return breakdowns
+
+    def store_breakdown(self, height, breakdown):
+        rows = [
+            (height, kind, str(name), count)
+            for kind, counts in zip(BREAKDOWN_KINDS, breakdown)
+            for name, count in counts.items()
+        ]
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM block_messages WHERE height = ?", (height,))
+            self._db.executemany("INSERT INTO block_messages VALUES (?, ?, ?, ?)", rows)
+            self._db.execute("INSERT OR REPLACE INTO decoded_blocks VALUES (?)", (height,))
+
+    def load_block_results(self, heights):
+        wanted = set(heights)
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT height, num_txs, gas_used, gas_wanted, failed_txs FROM block_results WHERE height BETWEEN ? AND ?",
+                (min(wanted), max(wanted)),
+            ).fetchall()
+        return {
+            height: {"height": height, "num_txs": num_txs, "gas_used": gas_used, "gas_wanted": gas_wanted,
+                     "failed_txs": failed_txs, "param_updates": None}
+            for height, num_txs, gas_used, gas_wanted, failed_txs in rows if height in wanted
+        }
+
+    def store_block_results(self, results):
+        rows = [(r["height"], r["num_txs"], r["gas_used"], r["gas_wanted"], r["failed_txs"]) for r in results]
+        params = [(r["height"] + 1, *r["param_updates"]) for r in results if r["param_updates"] is not None]
+        with self._lock, self._db:
+            self._db.executemany("INSERT OR REPLACE INTO block_results VALUES (?, ?, ?, ?, ?)", rows)
+            self._db.executemany("INSERT OR REPLACE INTO consensus_params VALUES (?, ?, ?, ?)", params)
+
+    def load_consensus_params(self, height):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT max_bytes, max_gas, max_gas_wanted FROM consensus_params WHERE height = ?", (height,)
+            ).fetchone()
+        return tuple(row) if row is not None else None
+
+    def load_param_updates(self, min_height, max_height):
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT height, max_bytes, max_gas, max_gas_wanted FROM consensus_params WHERE height BETWEEN ? AND ?",
+                (min_height, max_height),
+            ).fetchall()
+        return {height: tuple(params) for height, *params in rows}
+
+    def load_commits(self, heights):
+        wanted = set(heights)
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT height, round, signatures, signed, absent, nil_votes, participation, absent_validators "
+                "FROM commits WHERE height BETWEEN ? AND ?",
+                (min(wanted), max(wanted)),
+            ).fetchall()
+        return {
+            height: {"height": height, "round": commit_round, "signatures": signatures, "signed": signed,
+                     "absent": absent, "nil_votes": nil_votes, "participation": participation,
+                     "absent_validators": absent_validators.split(",") if absent_validators else []}
+            for height, commit_round, signatures, signed, absent, nil_votes, participation, absent_validators in rows
+            if height in wanted
+        }
+
+    def store_commits(self, commits):
+        rows = [
+            (c["height"], c["round"], c["signatures"], c["signed"], c["absent"], c["nil_votes"], c["participation"],
+             ",".join(c["absent_validators"]))
+            for c in commits
+        ]
+        with self._lock, self._db:
+            self._db.executemany("INSERT OR REPLACE INTO commits VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def store_consensus_params(self, height, params):
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO consensus_params VALUES (?, ?, ?, ?)", (height, *params))
+
+
+def tx_hash_key(tx_hash):
+    try:
+        return bytes.fromhex(tx_hash)
+    except ValueError:
+        return tx_hash.encode()
+
+
+class Progress:
+    def __init__(self, what, total):
+        self.what = what
+        self.total = total
+        self.count = 0
+        self.start = self.last_print = time.monotonic()
+
+    def update(self):
+        self.count += 1
+        now = time.monotonic()
+        if now - self.last_print >= PROGRESS_INTERVAL:
+            self.last_print = now
+            self._print(now)
+
+    def finish(self):
+        self._print(time.monotonic())
+
+    def _print(self, now):
+        elapsed = max(now - self.start, 1e-9)
+        total = f"/{self.total}" if self.total is not None else ""
+        print(f"{self.what}: {self.count}{total} in {elapsed:.1f}s ({self.count / elapsed:.1f}/s)", file=sys.stderr, flush=True)
+
+
+def tx_hash_file():
     home_path = os.path.expanduser('~')
-    filename = f"{home_path}/outputs/test_tx_hash"
-    with open(filename, "r") as f:
-        curr = f.readline()[:-1]
-        while curr:
-            height = get_block_height(curr)
-            curr = f.readline()[:-1]
-            if height is not None:
-                seen_heights.add(height)
+    return f"{home_path}/outputs/test_tx_hash"
+
+def normalize_tx_hash(line):
+    tx_hash = line.strip().upper()
+    return tx_hash[2:] if tx_hash.startswith("0X") else tx_hash
+
+def read_tx_hashes():
+    """
+    Streams the tx hashes of the run, skipping repeats seen within the last
+    TX_HASH_DEDUP_WINDOW hashes so memory stays bounded however long the file is.
+    """
+    recent = OrderedDict()
+    with open(tx_hash_file(), "r") as f:
+        for line in f:
+            tx_hash = normalize_tx_hash(line)
+            if not tx_hash:
+                continue
+            if tx_hash in recent:
+                recent.move_to_end(tx_hash)
+                continue
+            recent[tx_hash] = None
+            if len(recent) > TX_HASH_DEDUP_WINDOW:
+                recent.popitem(last=False)
+            yield tx_hash
+
+def parse_submit_time(value):
+    """
+    Returns a record's submit time as unix seconds.
+    """
+    try:
+        number = float(value)
+    except ValueError:
+        # 2023-02-27T23:00:44.214123456Z: keep microseconds, which is all strptime takes
+        date_time, _, fraction = value.rstrip("Z").partition(".")
+        parsed = datetime.strptime(f"{date_time}.{(fraction + '000000')[:6]}", DATE_TIME_FMT)
+        return (parsed - EPOCH).total_seconds()
+    for threshold, scale in SUBMIT_TIME_SCALES:
+        if number >= threshold:
+            return number / scale
+    return number
+
+def read_tx_records():
+    """
+    Streams (hash, submit time, message type, phase) from the tx record file, deduplicated
+    like read_tx_hashes. Message type and phase are None when the line does not have them.
+    """
+    recent = OrderedDict()
+    with open(args.tx_records_file, "r") as f:
+        for line in f:
+            fields = line.replace(",", " ").split()
+            if len(fields) < 2:
+                continue
+            tx_hash = normalize_tx_hash(fields[0])
+            if tx_hash in recent:
+                recent.move_to_end(tx_hash)
+                continue
+            recent[tx_hash] = None
+            if len(recent) > TX_HASH_DEDUP_WINDOW:
+                recent.popitem(last=False)
+            message_type = fields[2] if len(fields) > 2 else None
+            phase = fields[3] if len(fields) > 3 else None
+            yield tx_hash, parse_submit_time(fields[1]), message_type, phase
+
+def read_edge_tx_hashes(num_lines):
+    """
+    Returns up to num_lines hashes from the start and from the end of the tx hash file
+    without reading the lines in between.
+    """
+    with open(tx_hash_file(), "rb") as f:
+        head = []
+        for line in f:
+            if len(head) >= num_lines:
+                break
+            head.append(line)
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        f.seek(max(0, size - num_lines * 80))
+        tail = f.read().splitlines()[-num_lines:]
+    hashes = (normalize_tx_hash(line.decode()) for line in head + tail)
+    return list(dict.fromkeys(tx_hash for tx_hash in hashes if tx_hash))
+
+def batched(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def resolve_tx_heights(tx_hashes):
+    """
+    Looks up the heights of tx_hashes with a single JSON-RPC batch request. The result is
+    aligned with tx_hashes, with None for hashes the node does not know about. Heights found
+    in the block cache are not looked up again.
+    """
+    known = store.cache.load_tx_heights(tx_hashes) if store.cache is not None else {}
+    if len(known) < len(tx_hashes) and not client.offline:
+        unknown = [tx_hash for tx_hash in tx_hashes if tx_hash not in known]
+        payload = [
+            {"jsonrpc": "2.0", "id": i, "method": "tx", "params": {"hash": tx_hash}}
+            for i, tx_hash in enumerate(unknown)
+        ]
+        responses = client.post_json(RPC_PORT, "/", payload)
+        if isinstance(responses, dict) and len(payload) == 1 and responses.get("id") == 0:
+            # sei-tendermint answers a batch of one request with a single response object
+            responses = [responses]
+        if not isinstance(responses, list):
+            raise RuntimeError(f"JSON-RPC batch request failed: {responses}")
+        resolved = [(unknown[res["id"]], int(res["result"]["height"])) for res in responses if res.get("result")]
+        if store.cache is not None:
+            store.cache.store_tx_heights(resolved)
+        known.update(resolved)
+    return [known.get(tx_hash) for tx_hash in tx_hashes]
+
+def resolve_tx_records(records):
+    return resolve_tx_heights([record[0] for record in records])
+
+class TxRecords:
+    """
+    Submit time, inclusion height, message type and phase of every resolved tx record, kept
+    in compact columns since record files reach millions of lines.
+    """
+
+    def __init__(self):
+        self.submit_times = array("d")
+        self.heights = array("q")
+        self.message_type_ids = array("q")
+        self.phase_ids = array("q")
+        self.message_types = {}
+        self.phases = {}
+        self.unresolved = 0
+
+    def add(self, submit_time, height, message_type, phase):
+        self.submit_times.append(submit_time)
+        self.heights.append(height)
+        self.message_type_ids.append(self.message_types.setdefault(message_type, len(self.message_types)))
+        self.phase_ids.append(self.phases.setdefault(phase, len(self.phases)))
+
+def load_phases():
+    if not args.phases_file:
+        return []
+    with open(args.phases_file, "r") as f:
+        return sorted((float(phase["start"]), float(phase["end"]), phase["name"]) for phase in json.load(f))
+
+def phase_at(phases, starts, submit_time):
+    i = bisect_right(starts, submit_time) - 1
+    if i >= 0 and submit_time < phases[i][1]:
+        return phases[i][2]
+    return None
+
+def get_heights_in_batches():
+    seen_heights = set([])
+    batches = batched(read_tx_hashes(), args.tx_batch_size)
+    for _, heights in client.fetch_all(resolve_tx_heights, batches, "tx hash batches resolved"):
+        seen_heights.update(height for height in heights if height is not None)
+    return seen_heights
+
+def get_heights_from_records(tx_records):
+    phases = load_phases()
+    starts = [phase[0] for phase in phases]
+    batches = batched(read_tx_records(), args.tx_batch_size)
+    for records, heights in client.fetch_all(resolve_tx_records, batches, "tx record batches resolved"):
+        for (_, submit_time, message_type, phase), height in zip(records, heights):
+            if height is None:
+                tx_records.unresolved += 1
+                continue
+            if phase is None and phases:
+                phase = phase_at(phases, starts, submit_time)
+            tx_records.add(submit_time, height, message_type or "unknown", phase or "unassigned")
+    return set(tx_records.heights)
+
+def get_heights_in_range():
+    edge_heights = []
+    batches = batched(read_edge_tx_hashes(TX_HASH_EDGE_LINES), args.tx_batch_size)
+    for _, heights in client.fetch_all(resolve_tx_heights, batches, "edge tx hash batches resolved"):
+        edge_heights.extend(height for height in heights if height is not None)
+    if not edge_heights:
+        return set([])
+    all_heights = range(min(edge_heights), max(edge_heights) + 1)
+    store.load_headers(all_heights)
+    return set(height for height in all_heights if get_block_info(height)["number_of_txs"] > 0)
+
+def get_all_heights(tx_records=None):
+    if tx_records is not None:
+        seen_heights = get_heights_from_records(tx_records)
+    elif args.resolve == "range":
+        seen_heights = get_heights_in_range()
+    else:
+        seen_heights = get_heights_in_batches()
     return sorted(list(seen_heights))
 
-def get_block_info(height):
-    res = requests.get(f"http://{node_base_url}:26657/block?height={height}")
+def parse_block_info(height, block):
     #timestamp: "2023-02-27T23:00:44.214Z"
-    block = res.json()["block"]
     return {
         "height": height,
         "timestamp": datetime.strptime(block["header"]["time"][:26], DATE_TIME_FMT),
-        "number_of_txs": len(block["data"]["txs"])
+        "number_of_txs": len(block["data"]["txs"] or [])
     }
 
+def parse_block_meta(height, meta):
+    return {
+        "height": height,
+        "timestamp": datetime.strptime(meta["header"]["time"][:26], DATE_TIME_FMT),
+        "number_of_txs": int(meta["num_txs"]),
+        "block_size": int(meta["block_size"]),
+        "validators_hash": meta["header"].get("validators_hash"),
+    }
+
+def get_block_info(height):
+    return store.info(height)
+
 def get_block_time(height):
     return get_block_info(height)["timestamp"]
 
-"""
-This code is quite brittle as it handles different message types differently, and if we ever change the names of
-the proto or want to test more modules, we'll need to modify this. However, it works for now.
-"""
-def get_transaction_breakdown(height):
-    res = requests.get(f"http://{node_base_url}:26657/block?height={height}")
-    output = res.json()["block"]["data"]["txs"]
-    tx_mapping = {}
-    for tx in output:
-        module = None
-        b64_decoded = str(base64.b64decode(tx))
-        if "MsgSend" in b64_decoded:
-            module = "bank"
-        elif "MsgAggregateExchangeRateVote" in b64_decoded:
-            module = "oracle"
-        elif "MsgDelegate" in b64_decoded:
-            module = "staking"
-        elif "MsgCreateDenom" in b64_decoded:
-            module = "tokenfactory"
+def get_block_intervals(block_info_list):
+    """
+    Returns {height: milliseconds until the next block}. The next block is usually already in
+    the store; only the missing neighbours (the last height and gaps) are fetched.
+    """
+    store.load_headers(block["height"] + 1 for block in block_info_list)
+    return {
+        block["height"]: (get_block_time(block["height"] + 1) - block["timestamp"]) // timedelta(milliseconds=1)
+        for block in block_info_list
+    }
+
+def read_varint(buf, pos):
+    result, shift = 0, 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+        if shift >= 64:
+            raise ValueError("varint too long")
+
+def iter_proto_fields(buf):
+    """
+    Yields (field number, wire type, value) of a serialized protobuf message. Length-delimited
+    values are returned as raw bytes; nested messages are decoded by the caller.
+    """
+    pos = 0
+    while pos < len(buf):
+        key, pos = read_varint(buf, pos)
+        field, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, pos = read_varint(buf, pos)
+        elif wire_type == 1:
+            value, pos = buf[pos:pos + 8], pos + 8
+        elif wire_type == 2:
+            length, pos = read_varint(buf, pos)
+            value, pos = buf[pos:pos + length], pos + length
+        elif wire_type == 5:
+            value, pos = buf[pos:pos + 4], pos + 4
         else:
-            # Dex orders
-            for dex_msg in DEX_MSGS:
-                if dex_msg in b64_decoded:
-                    module = "dex"
-                    break
+            raise ValueError(f"unsupported wire type {wire_type}")
+        if pos > len(buf):
+            raise ValueError("truncated message")
+        yield field, wire_type, value
+
+def decode_any(buf):
+    type_url, value = "", b""
+    for field, wire_type, data in iter_proto_fields(buf):
+        if field == 1 and wire_type == 2:
+            type_url = data.decode()
+        elif field == 2 and wire_type == 2:
+            value = data
+    return type_url, value
+
+def decode_tx_messages(tx_bytes):
+    """
+    Returns the (type URL, value) of every message of a TxRaw: body_bytes is field 1 of TxRaw
+    and the messages are the repeated Any in field 1 of TxBody.
+    """
+    messages = []
+    for field, wire_type, body in iter_proto_fields(tx_bytes):
+        if field == 1 and wire_type == 2:
+            for body_field, body_wire_type, message in iter_proto_fields(body):
+                if body_field == 1 and body_wire_type == 2:
+                    messages.append(decode_any(message))
+    return messages
+
+def describe_message(type_url, value):
+    """
+    Labels a message by its type URL. EVM txs also carry the Ethereum tx type wrapped in
+    MsgEVMTransaction.data, and contract executions the name of the executed message, which is
+    how the loadtest tells e.g. wasm_occ_iterator_write from other wasm messages.
+    """
+    try:
+        if type_url == EVM_MSG_TYPE:
+            for field, wire_type, data in iter_proto_fields(value):
+                if field == 1 and wire_type == 2:
+                    inner_type_url, _ = decode_any(data)
+                    if inner_type_url:
+                        return f"{type_url}({inner_type_url.rsplit('.', 1)[-1]})"
+        elif type_url == WASM_EXECUTE_MSG_TYPE:
+            for field, wire_type, data in iter_proto_fields(value):
+                if field == 3 and wire_type == 2:
+                    msg = json.loads(data)
+                    if isinstance(msg, dict) and len(msg) == 1:
+                        return f"{type_url}({next(iter(msg))})"
+    except (ValueError, IndexError, UnicodeDecodeError):
+        pass
+    return type_url
+
+def module_of(type_url):
+    """
+    Module of a message type URL: the last package segment that is not a version, e.g. bank
+    for /cosmos.bank.v1beta1.MsgSend and dex for /seiprotocol.seichain.dex.MsgPlaceOrders.
+    """
+    packages = [part for part in type_url.lstrip("/").split(".")[:-1] if not PROTO_VERSION.match(part)]
+    return packages[-1] if packages else "other"
+
+def decode_block_txs(txs):
+    """
+    Returns the number of txs per module (of their first message), the number of messages per
+    message type and the number of txs per size in bytes of a block's base64 encoded txs. Runs
+    in the decode worker processes.
+    """
+    tx_modules, message_types, tx_sizes = Counter(), Counter(), Counter()
+    for tx in txs:
+        try:
+            tx_bytes = base64.b64decode(tx)
+            tx_sizes[len(tx_bytes)] += 1
+            messages = decode_tx_messages(tx_bytes)
+        except (ValueError, IndexError, UnicodeDecodeError):
+            messages = []
+        if not messages:
+            tx_modules[UNDECODABLE] += 1
+            message_types[UNDECODABLE] += 1
+            continue
+        tx_modules[module_of(messages[0][0])] += 1
+        for type_url, value in messages:
+            message_types[describe_message(type_url, value)] += 1
+    return tx_modules, message_types, tx_sizes
+
+def sorted_counts(counter):
+    return dict(sorted(counter.items(), key=lambda item: (-item[1], item[0])))
+
+def get_block_txs(height):
+    return store.block(height)["data"]["txs"] or []
+
+def decode_blocks(heights):
+    """
+    Yields (height, (tx modules, message types, tx sizes)) of every block in completion order.
+    Blocks are downloaded concurrently and decoded on a pool of --decode-workers processes,
+    with a bounded number of blocks waiting to be decoded.
+    """
+    cached = store.cache.load_breakdowns(heights) if store.cache is not None and heights else {}
+    yield from cached.items()
+    heights = [height for height in heights if height not in cached]
+    blocks = client.fetch_all(get_block_txs, heights, "blocks fetched for tx breakdown", total=len(heights))
+    for height, breakdown in decode_fetched_blocks(blocks):
+        if store.cache is not None:
+            store.cache.store_breakdown(height, breakdown)
+        yield height, breakdown
+
+def decode_fetched_blocks(blocks):
+    if args.decode_workers <= 0:
+        for height, txs in blocks:
+            yield height, decode_block_txs(txs)
+        return
+    # Spawned workers do not inherit the HTTP sessions and threads of this process
+    with ProcessPoolExecutor(args.decode_workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        pending = {}
+        for height, txs in blocks:
+            pending[pool.submit(decode_block_txs, txs)] = height
+            if len(pending) >= 2 * args.decode_workers:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield pending.pop(future), future.result()
+        for future in as_completed(pending):
+            yield pending[future], future.result()
+
+def summarize_counts(counter):
+    """
+    summarize() of a sample given as {value: number of occurrences}.
+    """
+    if not counter:
+        return None
+    values = np.fromiter(counter.keys(), dtype=np.float64, count=len(counter))
+    counts = np.fromiter(counter.values(), dtype=np.int64, count=len(counter))
+    return summarize(np.repeat(values, counts))
+
+def get_message_breakdown(heights):
+    per_block = {}
+    run_modules, run_message_types, run_tx_sizes = Counter(), Counter(), Counter()
+    for height, (tx_modules, message_types, tx_sizes) in decode_blocks(heights):
+        per_block[height] = {
+            "height": height,
+            "tx_modules": sorted_counts(tx_modules),
+            "message_types": sorted_counts(message_types),
+        }
+        run_modules.update(tx_modules)
+        run_message_types.update(message_types)
+        run_tx_sizes.update(tx_sizes)
+    return {
+        "tx_modules": sorted_counts(run_modules),
+        "message_types": sorted_counts(run_message_types),
+        "tx_size_bytes": summarize_counts(run_tx_sizes),
+        "blocks": [per_block[height] for height in sorted(per_block)],
+    }
+
+def get_transaction_breakdown(height):
+    cached = store.cache.load_breakdowns([height]) if store.cache is not None else {}
+    if height in cached:
+        breakdown = cached[height]
+    else:
+        breakdown = decode_block_txs(get_block_txs(height))
+        if store.cache is not None:
+            store.cache.store_breakdown(height, breakdown)
+    tx_modules, message_types, _ = breakdown
+    return sorted_counts(tx_modules), sorted_counts(message_types)
+
+def parse_block_results(height, results):
+    txs_results = results.get("txs_results") or []
+    param_updates = (results.get("consensus_param_updates") or {}).get("block")
+    return {
+        "height": height,
+        "num_txs": len(txs_results),
+        "gas_used": sum(int(tx.get("gas_used") or 0) for tx in txs_results),
+        "gas_wanted": sum(int(tx.get("gas_wanted") or 0) for tx in txs_results),
+        "failed_txs": sum(1 for tx in txs_results if tx.get("code", 0) != 0),
+        "param_updates": parse_block_params(param_updates) if param_updates else None,
+    }
+
+def parse_block_params(block_params):
+    """
+    (max_bytes, max_gas, max_gas_wanted) of consensus block params; -1 means unlimited.
+    """
+    return (
+        int(block_params.get("max_bytes") or -1),
+        int(block_params.get("max_gas") or -1),
+        int(block_params.get("max_gas_wanted") or -1),
+    )
+
+def fetch_block_results(height):
+    return parse_block_results(height, client.get_json(RPC_PORT, f"/block_results?height={height}"))
+
+def load_block_results(heights):
+    results = store.cache.load_block_results(heights) if store.cache is not None and heights else {}
+    missing = [height for height in heights if height not in results]
+    fetched = [r for _, r in client.fetch_all(fetch_block_results, missing, "block results fetched", total=len(missing))]
+    if store.cache is not None:
+        store.cache.store_block_results(fetched)
+    results.update((r["height"], r) for r in fetched)
+    return results
 
+def load_consensus_params(heights):
+    """
+    Returns the cached param updates {height: params} within heights and the params in effect
+    at the first height, each as (max_bytes, max_gas, max_gas_wanted). Together with the updates
+    returned by the block results of the run they give the limits of every block; updates made
+    in blocks outside the run are not seen.
+    """
+    first = min(heights)
+    params = store.cache.load_consensus_params(first) if store.cache is not None else None
+    if params is None:
+        body = client.get_json(RPC_PORT, f"/consensus_params?height={first}")
+        params = parse_block_params(body["consensus_params"]["block"])
+        if store.cache is not None:
+            store.cache.store_consensus_params(first, params)
+    updates = store.cache.load_param_updates(first + 1, max(heights)) if store.cache is not None else {}
+    return updates, params
 
-        # Attributes may not be defined for custom module
-        if module == None:
-            module = "other"
-        if module not in tx_mapping:
-            tx_mapping[module] = 1
+def ratio(numerator, limit):
+    return numerator / limit if limit > 0 else None
+
+def get_gas_stats(block_info_list, block_intervals, message_breakdown):
+    """
+    Gas, failed txs and fullness against the consensus block limits per block, to tell a run
+    that was bounded by execution from one that filled its blocks.
+    """
+    heights = [block["height"] for block in block_info_list]
+    results = load_block_results(heights)
+    updates, params = load_consensus_params(heights)
+    consensus_params = dict(zip(("max_bytes", "max_gas", "max_gas_wanted"), params))
+    for r in results.values():
+        if r["param_updates"] is not None:
+            updates[r["height"] + 1] = r["param_updates"]
+    blocks = []
+    for block in block_info_list:
+        height = block["height"]
+        params = updates.get(height, params)
+        max_bytes, max_gas, max_gas_wanted = params
+        r = results[height]
+        block_time = block_intervals[height]
+        block_size = block.get("block_size")
+        blocks.append({
+            "height": height,
+            "gas_used": r["gas_used"],
+            "gas_wanted": r["gas_wanted"],
+            "failed_txs": r["failed_txs"],
+            "gas_used_per_sec": r["gas_used"] * 1000 / block_time if block_time > 0 else None,
+            "gas_used_fullness": ratio(r["gas_used"], max_gas),
+            "gas_wanted_fullness": ratio(r["gas_wanted"], max_gas_wanted if max_gas_wanted > 0 else max_gas),
+            "bytes_fullness": ratio(block_size, max_bytes) if block_size is not None else None,
+        })
+
+    def series(key):
+        return np.array([block[key] for block in blocks if block[key] is not None], dtype=np.float64)
+
+    def near_limit(key):
+        values = series(key)
+        return int((values >= FULL_BLOCK_THRESHOLD).sum()) if values.size else None
+
+    total_gas_used = sum(block["gas_used"] for block in blocks)
+    total_time_ms = sum(block_intervals[height] for height in heights)
+    total_txs = sum(results[height]["num_txs"] for height in heights)
+    if message_breakdown is not None:
+        tx_size = message_breakdown["tx_size_bytes"]
+    else:
+        # Without the txs only the average size per block is known, including header and commit
+        tx_size = summarize(np.array([
+            block["block_size"] / block["number_of_txs"]
+            for block in block_info_list if block.get("block_size") is not None and block["number_of_txs"] > 0
+        ], dtype=np.float64))
+    return {
+        "total_gas_used": total_gas_used,
+        "total_gas_wanted": sum(block["gas_wanted"] for block in blocks),
+        "gas_used_per_sec": total_gas_used * 1000 / total_time_ms if total_time_ms > 0 else None,
+        "failed_tx_ratio": sum(block["failed_txs"] for block in blocks) / total_txs if total_txs else None,
+        "consensus_params": consensus_params,
+        "gas_used": summarize(series("gas_used")),
+        "gas_wanted": summarize(series("gas_wanted")),
+        "gas_used_per_sec_per_block": summarize(series("gas_used_per_sec")),
+        "gas_used_fullness": summarize(series("gas_used_fullness")),
+        "gas_wanted_fullness": summarize(series("gas_wanted_fullness")),
+        "bytes_fullness": summarize(series("bytes_fullness")),
+        "blocks_near_gas_limit": near_limit("gas_wanted_fullness"),
+        "blocks_near_bytes_limit": near_limit("bytes_fullness"),
+        "tx_size_bytes": tx_size,
+        "tx_size_from": "txs (incl. edge blocks)" if message_breakdown is not None else "block size / txs",
+        "blocks": blocks,
+    }
+
+def fetch_validator_set(height):
+    """
+    Returns [(address, voting power)] of the validators at height, in the order of the
+    signatures of the commits they sign.
+    """
+    validators, page = [], 1
+    while True:
+        body = client.get_json(RPC_PORT, f"/validators?height={height}&page={page}&per_page={VALIDATORS_PAGE_SIZE}")
+        validators += body["validators"]
+        if not body["validators"] or len(validators) >= int(body["total"]):
+            return [(validator["address"], int(validator["voting_power"])) for validator in validators]
+        page += 1
+
+def summarize_commit(height, commit, validator_set):
+    """
+    Signature counts of the commit of a height. Absent signatures carry no address, so absent
+    validators are named by their position in the validator set; participation is the share
+    of voting power that signed for the block.
+    """
+    signatures = commit["signatures"] or []
+    signed, absent, nil_votes, signed_power, total_power = 0, 0, 0, 0, 0
+    absent_validators = []
+    for i, signature in enumerate(signatures):
+        address, power = validator_set[i] if i < len(validator_set) else (signature.get("validator_address") or f"#{i}", 1)
+        total_power += power
+        flag = signature["block_id_flag"]
+        flag = BLOCK_ID_FLAGS.get(flag, flag)
+        if flag == BLOCK_ID_FLAG_COMMIT:
+            signed += 1
+            signed_power += power
+        elif flag == BLOCK_ID_FLAG_NIL:
+            nil_votes += 1
         else:
-            tx_mapping[module] += 1
-    return tx_mapping
+            absent += 1
+            absent_validators.append(address)
+    return {
+        "height": height,
+        "round": int(commit["round"]),
+        "signatures": len(signatures),
+        "signed": signed,
+        "absent": absent,
+        "nil_votes": nil_votes,
+        "participation": signed_power / total_power if total_power else 0.0,
+        "absent_validators": absent_validators,
+    }
+
+def load_commits(heights):
+    """
+    Commit summaries of heights. Validator sets are fetched once per distinct validators_hash
+    of the headers, then the commits are fetched and summarized concurrently.
+    """
+    commits = store.cache.load_commits(heights) if store.cache is not None and heights else {}
+    missing = [height for height in heights if height not in commits]
+    if not missing:
+        return commits
+    set_heights = {}
+    for height in missing:
+        set_heights.setdefault(get_block_info(height).get("validators_hash") or height, height)
+    validator_sets = {
+        height: validator_set
+        for height, validator_set in client.fetch_all(
+            fetch_validator_set, set_heights.values(), "validator sets fetched", total=len(set_heights))
+    }
+
+    def fetch_commit(height):
+        result = client.get_json(RPC_PORT, f"/commit?height={height}")
+        validators_hash = get_block_info(height).get("validators_hash") or height
+        commit = summarize_commit(height, result["signed_header"]["commit"], validator_sets[set_heights[validators_hash]])
+        return commit, result.get("canonical", True)
+
+    fetched = [result for _, result in client.fetch_all(fetch_commit, missing, "commits fetched", total=len(missing))]
+    if store.cache is not None:
+        # The commit of the latest height is not final yet and may still gain signatures
+        store.cache.store_commits([commit for commit, canonical in fetched if canonical])
+    commits.update((commit["height"], commit) for commit, _ in fetched)
+    return commits
 
-def get_best_block_stats(block_info_list):
+def correlation(x, y):
+    if len(x) < 2 or np.std(x) == 0 or np.std(y) == 0:
+        return None
+    return float(np.corrcoef(x, y)[0, 1])
+
+def get_consensus_stats(block_info_list, block_intervals):
+    """
+    Commit participation, absent validators and rounds per block, compared between slow blocks
+    and the rest. A slow block that needed more than one round or missed signatures points at
+    consensus and the network rather than at execution.
+    """
+    heights = [block["height"] for block in block_info_list]
+    commits = load_commits(heights)
+    intervals_ms = np.array([block_intervals[height] for height in heights], dtype=np.float64)
+    rounds = np.array([commits[height]["round"] for height in heights], dtype=np.float64)
+    participation = np.array([commits[height]["participation"] for height in heights], dtype=np.float64)
+    absent = np.array([commits[height]["absent"] for height in heights], dtype=np.float64)
+    threshold_ms = float(np.median(intervals_ms)) * args.slow_block_factor
+    slow = intervals_ms >= threshold_ms
+
+    def group(mask):
+        return {
+            "blocks": int(mask.sum()),
+            "with_round_above_0": int((rounds[mask] > 0).sum()),
+            "with_absent_validators": int((absent[mask] > 0).sum()),
+            "participation": summarize(participation[mask]),
+            "block_time_ms": summarize(intervals_ms[mask]),
+        }
+
+    absent_counts = Counter(address for height in heights for address in commits[height]["absent_validators"])
+    return {
+        "slow_block_threshold_ms": threshold_ms,
+        "blocks_with_round_above_0": int((rounds > 0).sum()),
+        "blocks_with_absent_validators": int((absent > 0).sum()),
+        "participation": summarize(participation),
+        "slow_blocks": group(slow),
+        "other_blocks": group(~slow),
+        "correlation": {
+            "block_time_vs_round": correlation(intervals_ms, rounds),
+            "block_time_vs_absent_validators": correlation(intervals_ms, absent),
+            "block_time_vs_participation": correlation(intervals_ms, participation),
+        },
+        "most_absent_validators": sorted_counts(Counter(dict(absent_counts.most_common(TOP_ABSENT_VALIDATORS)))),
+        "blocks": [
+            dict(commits[height], block_time_ms=block_intervals[height], slow=bool(is_slow))
+            for height, is_slow in zip(heights, slow)
+        ],
+    }
+
+def get_best_block_stats(block_info_list, block_intervals):
     max_throughput, max_block_height, max_block_time = -1, -1, -1
     for i in range(len(block_info_list)):
         block = block_info_list[i]
-        next_block_time = get_block_time(block["height"] + 1)
-        block_time = (next_block_time - block["timestamp"]) // timedelta(milliseconds=1)
+        block_time = block_intervals[block["height"]]
         throughput = block["number_of_txs"] * 1000 / block_time
         print(f"Block {block['height']} has throughput {throughput} and block time {block_time} ms")
         if throughput > max_throughput:
@@ -95,31 +1144,239 @@ def get_best_block_stats(block_info_list):
             max_block_height = block["height"]
             max_block_time = block_time
     return max_throughput, max_block_height, max_block_time
+def summarize(values):
+    if values.size == 0:
+        return None
+    summary = {f"p{p}": value for p, value in zip(PERCENTILES, np.percentile(values, PERCENTILES).tolist())}
+    summary.update({
+        "min": float(values.min()),
+        "max": float(values.max()),
+        "mean": float(values.mean()),
+        "std": float(values.std()),
+        "count": int(values.size),
+        "sum": float(values.sum()),
+    })
+    return summary
+
+def get_rolling_tps(heights, txs, intervals_ms, window):
+    """
+    TPS over every run of `window` consecutive blocks: txs of the window divided by the time
+    from the first block of the window to the block after its last one.
+    """
+    if window <= 0 or len(heights) < window:
+        return []
+    txs_sum = np.convolve(txs, np.ones(window), mode="valid")
+    time_ms = np.convolve(intervals_ms, np.ones(window), mode="valid")
+    tps = np.divide(txs_sum * 1000, time_ms, out=np.zeros_like(txs_sum), where=time_ms > 0)
+    return [{"height": int(height), "tps": value} for height, value in zip(heights[window - 1:], tps.tolist())]
+
+def get_distribution_stats(block_info_list, block_intervals):
+    """
+    Percentiles, spread and histogram of the per-block series, so that slow tail blocks show
+    up next to the averages.
+    """
+    heights = np.array([block["height"] for block in block_info_list], dtype=np.int64)
+    txs = np.array([block["number_of_txs"] for block in block_info_list], dtype=np.float64)
+    intervals_ms = np.array([block_intervals[block["height"]] for block in block_info_list], dtype=np.float64)
+    tps = np.divide(txs * 1000, intervals_ms, out=np.zeros_like(txs), where=intervals_ms > 0)
+    counts, edges = np.histogram(intervals_ms, bins=args.histogram_bins)
+    rolling_tps = get_rolling_tps(heights, txs, intervals_ms, args.rolling_window)
+    return {
+        "block_time_ms": summarize(intervals_ms),
+        "tps": summarize(tps),
+        "txs_per_block": summarize(txs),
+        "block_time_histogram_ms": {
+            "bucket_edges": edges.tolist(),
+            "counts": counts.tolist(),
+        },
+        "rolling_tps": {
+            "window_blocks": args.rolling_window,
+            "max": max((point["tps"] for point in rolling_tps), default=None),
+            "min": min((point["tps"] for point in rolling_tps), default=None),
+            "points": rolling_tps,
+        },
+    }
+
+def get_latency_stats(tx_records):
+    """
+    Latency of every resolved record from submission to the time of its block (inclusion) and
+    to the time of the next block, by which the block has been committed. Block times are
+    proposer times, so clock skew between client and validators shows up as negative latencies.
+    """
+    if not tx_records.heights:
+        return None
+    submit_times = np.frombuffer(tx_records.submit_times, dtype=np.float64)
+    heights, height_index = np.unique(np.frombuffer(tx_records.heights, dtype=np.int64), return_inverse=True)
+    store.load_headers(heights.tolist() + (heights + 1).tolist())
+    block_times = np.array([(get_block_time(int(height)) - EPOCH).total_seconds() for height in heights])
+    next_block_times = np.array([(get_block_time(int(height) + 1) - EPOCH).total_seconds() for height in heights])
+    inclusion = block_times[height_index] - submit_times
+    commit = next_block_times[height_index] - submit_times
+
+    def breakdown(ids, names):
+        ids = np.frombuffer(ids, dtype=np.int64)
+        return {
+            name: {
+                "inclusion_seconds": summarize(inclusion[ids == i]),
+                "commit_seconds": summarize(commit[ids == i]),
+            }
+            for name, i in names.items()
+        }
+
+    return {
+        "records": len(submit_times) + tx_records.unresolved,
+        "unresolved": tx_records.unresolved,
+        "negative": int((inclusion < 0).sum()),
+        "inclusion_seconds": summarize(inclusion),
+        "commit_seconds": summarize(commit),
+        "by_message_type": breakdown(tx_records.message_type_ids, tx_records.message_types),
+        "by_phase": breakdown(tx_records.phase_ids, tx_records.phases),
+    }
+
+def format_prometheus_summary(name, help_text, summary, scale=1.0, labels=None):
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} summary"] if help_text else []
+    label_text = "".join(f'{key}="{value}",' for key, value in (labels or {}).items())
+    for p in PERCENTILES:
+        lines.append(f'{name}{{{label_text}quantile="{p / 100}"}} {summary[f"p{p}"] * scale}')
+    suffix = f"{{{label_text.rstrip(',')}}}" if label_text else ""
+    lines.append(f"{name}_sum{suffix} {summary['sum'] * scale}")
+    lines.append(f"{name}_count{suffix} {summary['count']}")
+    return lines
+
+def format_prometheus_latency(latency):
+    lines = []
+    for kind in ("inclusion", "commit"):
+        name = f"sei_loadtest_tx_{kind}_latency_seconds"
+        lines += format_prometheus_summary(name, f"Time from tx submission to {kind}.", latency[f"{kind}_seconds"])
+        for label, breakdown in (("message_type", latency["by_message_type"]), ("phase", latency["by_phase"])):
+            for value, stats in breakdown.items():
+                if stats[f"{kind}_seconds"] is not None:
+                    lines += format_prometheus_summary(name, None, stats[f"{kind}_seconds"], labels={label: value})
+    return lines
+
+def format_prometheus_gas(gas):
+    lines = []
+    for key, name, help_text in (
+        ("gas_used_per_sec_per_block", "sei_loadtest_block_gas_used_per_second", "Gas used by a block divided by its block time."),
+        ("gas_wanted_fullness", "sei_loadtest_block_gas_wanted_fullness_ratio", "Gas wanted by a block relative to the block gas limit."),
+        ("bytes_fullness", "sei_loadtest_block_bytes_fullness_ratio", "Size of a block relative to the block size limit."),
+        ("tx_size_bytes", "sei_loadtest_tx_size_bytes", "Size of a tx."),
+    ):
+        if gas[key] is not None:
+            lines += format_prometheus_summary(name, help_text, gas[key])
+    if gas["failed_tx_ratio"] is not None:
+        name = "sei_loadtest_failed_tx_ratio"
+        lines += [f"# HELP {name} Share of included txs that failed.", f"# TYPE {name} gauge", f"{name} {gas['failed_tx_ratio']}"]
+    return lines
+
+def format_prometheus_consensus(consensus):
+    lines = []
+    if consensus["participation"] is not None:
+        lines += format_prometheus_summary(
+            "sei_loadtest_commit_participation_ratio", "Share of voting power that signed a block's commit.",
+            consensus["participation"])
+    for key, name, help_text in (
+        ("blocks_with_round_above_0", "sei_loadtest_blocks_with_round_above_0", "Blocks committed after more than one round."),
+        ("blocks_with_absent_validators", "sei_loadtest_blocks_with_absent_validators", "Blocks whose commit misses signatures."),
+    ):
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {consensus[key]}"]
+    return lines
+
+def write_prometheus_file(path, distribution, latency=None, gas=None, consensus=None):
+    lines = []
+    if distribution["block_time_ms"] is not None:
+        lines += format_prometheus_summary(
+            "sei_loadtest_block_time_seconds", "Time from a block to the next one.", distribution["block_time_ms"], 1 / 1000)
+        lines += format_prometheus_summary(
+            "sei_loadtest_block_tps", "Txs of a block divided by its block time.", distribution["tps"])
+        lines += format_prometheus_summary(
+            "sei_loadtest_block_txs", "Number of txs in a block.", distribution["txs_per_block"])
+        histogram = distribution["block_time_histogram_ms"]
+        name = "sei_loadtest_block_time_histogram_seconds"
+        lines += [f"# HELP {name} Distribution of block times.", f"# TYPE {name} histogram"]
+        for edge, cumulative in zip(histogram["bucket_edges"][1:], np.cumsum(histogram["counts"]).tolist()):
+            lines.append(f'{name}_bucket{{le="{edge / 1000}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{le="+Inf"}} {distribution["block_time_ms"]["count"]}')
+        lines.append(f"{name}_sum {distribution['block_time_ms']['sum'] / 1000}")
+        lines.append(f"{name}_count {distribution['block_time_ms']['count']}")
+        for stat in ("max", "min"):
+            if distribution["rolling_tps"][stat] is not None:
+                name = f"sei_loadtest_rolling_tps_{stat}"
+                lines += [
+                    f"# HELP {name} {stat.capitalize()} TPS over {distribution['rolling_tps']['window_blocks']} consecutive blocks.",
+                    f"# TYPE {name} gauge",
+                    f"{name} {distribution['rolling_tps'][stat]}",
+                ]
+    if latency is not None:
+        lines += format_prometheus_latency(latency)
+    if gas is not None:
+        lines += format_prometheus_gas(gas)
+    if consensus is not None:
+        lines += format_prometheus_consensus(consensus)
+    with open(path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+def open_block_cache():
+    """
+    Opens the block cache of the chain being analysed. Online, the chain id and earliest block
+    come from /status; offline, the chain id is --chain-id or the only one cached.
+    """
+    if args.no_block_cache:
+        if args.offline:
+            sys.exit("--offline needs the block cache")
+        return None
+    if args.offline:
+        chain_id = args.chain_id
+        if chain_id is None:
+            cached = sorted(name[len("blocks-"):-len(".sqlite")] for name in os.listdir(args.block_cache_dir)
+                            if name.startswith("blocks-") and name.endswith(".sqlite")) if os.path.isdir(args.block_cache_dir) else []
+            if len(cached) != 1:
+                sys.exit(f"--offline needs --chain-id, cached chains: {', '.join(cached) or 'none'}")
+            chain_id = cached[0]
+        path = os.path.join(args.block_cache_dir, f"blocks-{chain_id}.sqlite")
+        if not os.path.exists(path):
+            sys.exit(f"no block cache for chain {chain_id} in {args.block_cache_dir}")
+        return BlockCache(path)
+    status = client.get_json(RPC_PORT, "/status")
+    cache = BlockCache(os.path.join(args.block_cache_dir, f"blocks-{status['node_info']['network']}.sqlite"))
+    cache.check_chain(status["sync_info"].get("earliest_block_hash", ""))
+    return cache
+
 def get_metrics():
-    all_heights = get_all_heights()
+    store.cache = open_block_cache()
+    tx_records = TxRecords() if args.latency else None
+    all_heights = get_all_heights(tx_records)
     if len(all_heights) <= 2:
         print("Not enough number of blocks to obtain meaningful metrics with. Exiting..")
         return
-    block_info_list = []
-    for height in all_heights:
-        block_info_list.append(get_block_info(height))
+    # Headers of the next heights are needed for block times, so they share the same ranges
+    store.load_headers(all_heights + [height + 1 for height in all_heights])
+    block_info_list = [get_block_info(height) for height in all_heights]
     # Skip first and last block since it may have high deviation if we start it at the end of the block
 
+    block_intervals = get_block_intervals(block_info_list)
     skip_edge_blocks = block_info_list[1:-1]
     total_duration = 0
     for i in range(len(skip_edge_blocks)):
         block = skip_edge_blocks[i]
-        next_block_time = get_block_time(block["height"] + 1)
-        block_time = (next_block_time - block["timestamp"]) // timedelta(milliseconds=1)
-        total_duration += block_time
+        total_duration += block_intervals[block["height"]]
     average_block_time = total_duration / 1000 / len(skip_edge_blocks)
     total_txs_num = sum([block["number_of_txs"] for block in skip_edge_blocks])
     average_txs_num = total_txs_num / len(skip_edge_blocks)
 
     # Best block stats:
-    max_throughput, max_block_height, max_block_time = get_best_block_stats(block_info_list)
+    max_throughput, max_block_height, max_block_time = get_best_block_stats(block_info_list, block_intervals)
 
-    tx_mapping = get_transaction_breakdown(max_block_height)
+    message_breakdown = None
+    if args.tx_breakdown:
+        message_breakdown = get_message_breakdown(all_heights)
+        best_block = next(block for block in message_breakdown["blocks"] if block["height"] == max_block_height)
+        tx_mapping, message_types = best_block["tx_modules"], best_block["message_types"]
+    else:
+        tx_mapping, message_types = get_transaction_breakdown(max_block_height)
+    print(f"header requests: {store.header_requests}, blocks downloaded: {store.downloads}", file=sys.stderr)
+
+    distribution = get_distribution_stats(skip_edge_blocks, block_intervals)
 
     return {
         "Summary (excl. edge block)": {
@@ -138,8 +1395,174 @@ def get_metrics():
             "height": max_block_height,
             "tps": max_throughput,
             "tx_mapping": tx_mapping,
+            "message_types": message_types,
             "block_time_ms": max_block_time
-        }
+        },
+        "Distribution (excl. edge blocks)": distribution,
+        "Message breakdown (incl. edge blocks)": message_breakdown,
+        "Latency": get_latency_stats(tx_records) if tx_records is not None else None,
+        "Gas (excl. edge blocks)": get_gas_stats(skip_edge_blocks, block_intervals, message_breakdown) if args.gas else None,
+        "Consensus (excl. edge blocks)": get_consensus_stats(skip_edge_blocks, block_intervals) if args.consensus else None,
     }
 
-print(json.dumps(get_metrics(), indent=4))
+class LiveWindow:
+    """
+    Ring buffer of the last `size` blocks seen in --live mode. Rolling TPS is the number of
+    txs committed after the oldest block divided by the time since it.
+    """
+
+    def __init__(self, size):
+        self.blocks = deque(maxlen=size)
+
+    def add(self, height, timestamp, number_of_txs):
+        previous = self.blocks[-1] if self.blocks else None
+        self.blocks.append((height, timestamp, number_of_txs))
+        stats = {
+            "height": height,
+            "time": timestamp.isoformat(),
+            "number_of_txs": number_of_txs,
+            "block_time_ms": None,
+            "tps": None,
+            "window_blocks": len(self.blocks),
+            "rolling_block_time_ms": None,
+            "rolling_tps": None,
+            "rolling_txs_per_block": sum(block[2] for block in self.blocks) / len(self.blocks),
+        }
+        if previous is not None and previous[0] == height - 1:
+            block_time = (timestamp - previous[1]) // timedelta(milliseconds=1)
+            stats["block_time_ms"] = block_time
+            stats["tps"] = number_of_txs * 1000 / block_time if block_time > 0 else None
+        oldest = self.blocks[0]
+        if len(self.blocks) > 1:
+            elapsed = (timestamp - oldest[1]) // timedelta(milliseconds=1)
+            if elapsed > 0:
+                stats["rolling_block_time_ms"] = elapsed / (height - oldest[0])
+                stats["rolling_tps"] = sum(block[2] for block in list(self.blocks)[1:]) * 1000 / elapsed
+        return stats
+
+
+def format_live_stats(stats):
+    def fmt(value, spec):
+        return "-" if value is None else format(value, spec)
+    return (
+        f"Block {stats['height']}: {stats['number_of_txs']} txs, "
+        f"block time {fmt(stats['block_time_ms'], 'd')} ms, tps {fmt(stats['tps'], '.1f')} | "
+        f"last {stats['window_blocks']} blocks: block time {fmt(stats['rolling_block_time_ms'], '.0f')} ms, "
+        f"tps {fmt(stats['rolling_tps'], '.1f')}, txs/block {stats['rolling_txs_per_block']:.1f}"
+    )
+
+
+def subscribe_new_blocks():
+    """
+    Yields every NewBlock event's block from the node's websocket, reconnecting when the
+    connection drops. websocket-client is only needed for this mode.
+    """
+    try:
+        import websocket
+    except ImportError:
+        sys.exit("--live needs the websocket-client package: pip install websocket-client")
+    url = f"ws://{node_base_url}:{RPC_PORT}/websocket"
+    subscribe = {"jsonrpc": "2.0", "method": "subscribe", "id": 0, "params": {"query": "tm.event='NewBlock'"}}
+    while True:
+        try:
+            ws = websocket.create_connection(url, timeout=args.timeout)
+            ws.settimeout(None)
+            ws.send(json.dumps(subscribe))
+            print(f"subscribed to new blocks on {url}", file=sys.stderr, flush=True)
+            while True:
+                message = json.loads(ws.recv())
+                if "error" in message:
+                    sys.exit(f"subscription failed: {message['error']}")
+                data = (message.get("result") or {}).get("data")
+                if data:
+                    yield data["value"]["block"]
+        except (websocket.WebSocketException, OSError) as e:
+            print(f"websocket error: {e}, reconnecting in {LIVE_RECONNECT_SECONDS}s", file=sys.stderr, flush=True)
+            time.sleep(LIVE_RECONNECT_SECONDS)
+
+
+def run_live():
+    window = LiveWindow(args.live_window)
+    output = open(args.live_output, "a") if args.live_output else None
+    seen = 0
+    try:
+        for block in subscribe_new_blocks():
+            height = int(block["header"]["height"])
+            timestamp = datetime.strptime(block["header"]["time"][:26], DATE_TIME_FMT)
+            stats = window.add(height, timestamp, len(block["data"]["txs"] or []))
+            print(format_live_stats(stats), flush=True)
+            if output is not None:
+                output.write(json.dumps(stats) + "\n")
+                output.flush()
+            seen += 1
+            if args.live_blocks and seen >= args.live_blocks:
+                break
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if output is not None:
+            output.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--node", default="localhost", help="Node base URL")
+    parser.add_argument("--concurrency", type=int, default=32, help="Maximum number of requests in flight")
+    parser.add_argument("--timeout", type=float, default=10, help="Timeout of a single request in seconds")
+    parser.add_argument("--retries", type=int, default=3, help="Retries of a failed request")
+    parser.add_argument("--tx-batch-size", type=int, default=100, help="Number of tx hashes resolved per JSON-RPC batch request")
+    parser.add_argument("--resolve", choices=["batch", "range"], default="batch",
+                        help="batch: look up every tx hash; range: only look up the hashes at both ends of the file "
+                             "and take every block in between that has txs")
+    parser.add_argument("--rolling-window", type=int, default=10, help="Number of blocks the rolling TPS curve is computed over")
+    parser.add_argument("--histogram-bins", type=int, default=20, help="Number of buckets of the block time histogram")
+    parser.add_argument("--output", help="Also write the JSON metrics to this file")
+    parser.add_argument("--prometheus-file", help="Write the block time, TPS and txs/block distributions to this file in the Prometheus text format")
+    parser.add_argument("--tx-breakdown", action="store_true",
+                        help="Decode the txs of every block for per-block and whole-run message type breakdowns")
+    parser.add_argument("--decode-workers", type=int, default=os.cpu_count(),
+                        help="Processes decoding txs for --tx-breakdown, 0 to decode in this process")
+    parser.add_argument("--latency", action="store_true",
+                        help="Report submit-to-inclusion latency from the tx record file, which then replaces the tx hash file")
+    parser.add_argument("--tx-records-file", default=os.path.expanduser("~/outputs/test_tx_records"),
+                        help="Lines of 'hash,submit_time[,message_type[,phase]]'; submit_time is a unix timestamp in "
+                             "seconds, milliseconds, microseconds or nanoseconds, or an RFC 3339 UTC time")
+    parser.add_argument("--phases-file",
+                        help="JSON list of {name, start, end} (unix seconds) assigning a load phase by submit time "
+                             "to records that do not name one")
+    parser.add_argument("--gas", action="store_true",
+                        help="Report gas use, failed txs and block fullness from /block_results and the consensus params; "
+                             "with --tx-breakdown also the exact tx size distribution")
+    parser.add_argument("--consensus", action="store_true",
+                        help="Report commit participation, absent validators and rounds above 0 per block, "
+                             "compared between slow blocks and the rest")
+    parser.add_argument("--slow-block-factor", type=float, default=1.5,
+                        help="A block is slow when its block time is at least this many times the median")
+    parser.add_argument("--block-cache-dir", default=os.path.expanduser("~/outputs/block_cache"),
+                        help="Directory of the local block cache, one SQLite database per chain id")
+    parser.add_argument("--no-block-cache", action="store_true", help="Neither read nor update the local block cache")
+    parser.add_argument("--offline", action="store_true", help="Only use the local block cache, never the node")
+    parser.add_argument("--chain-id", help="Chain whose block cache --offline reads; needed when the cache has several")
+    parser.add_argument("--live", action="store_true", help="Follow new blocks over the node's websocket instead of reading the tx hash file")
+    parser.add_argument("--live-window", type=int, default=20, help="Number of most recent blocks the rolling --live stats are computed over")
+    parser.add_argument("--live-blocks", type=int, default=0, help="Stop --live mode after this many blocks, 0 to run until interrupted")
+    parser.add_argument("--live-output", help="Append one JSON line of --live stats per block to this file")
+    args = parser.parse_args()
+    node_base_url = args.node
+    client = NodeClient(node_base_url, args.concurrency, args.timeout, args.retries, args.offline)
+    store = BlockStore(client)
+
+    if args.live:
+        run_live()
+    else:
+        try:
+            metrics = get_metrics()
+        except OfflineError as e:
+            sys.exit(str(e))
+        print(json.dumps(metrics, indent=4))
+        if metrics is not None and args.output:
+            with open(args.output, "w") as f:
+                json.dump(metrics, f, indent=4)
+        if metrics is not None and args.prometheus_file:
+            write_prometheus_file(args.prometheus_file, metrics["Distribution (excl. edge blocks)"], metrics["Latency"],
+                                  metrics["Gas (excl. edge blocks)"], metrics["Consensus (excl. edge blocks)"])
@@ -1,10 +1,23 @@
 import argparse
+import base64
+import csv
+import itertools
+import hashlib
 import json
+import math
 import os
+import re
+import shlex
+import signal
 import subprocess
 import tempfile
+import threading
+import time
+import urllib.request
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from fractions import Fraction
 
 
 # This strategy is used to simulate sudden spikes or bursts of load on the on the chain.
@@ -20,10 +33,121 @@ STEADY = 'STEADY'
 # traffic that may break nodes that fall behind.
 CONTINUOUS = 'CONTINUOUS'
 
+# Runs a declarative timeline of phases (ramp-up, plateau, spike, cool-down, ...), each with
+# its own target_tps and message mix, handing over from one phase to the next without a gap.
+TIMELINE = 'TIMELINE'
+
+# Line the Go client prints when its producers start sending, i.e. when a phase really starts
+CLIENT_READY_MARKER = "Starting loadtest producers and consumers"
+# Seconds a client gets to shut down after SIGINT before it is killed
+CLIENT_STOP_TIMEOUT = 60
+# Startup time assumed for the first client; later ones use the last measured startup time
+DEFAULT_CLIENT_STARTUP_SECONDS = 10
+# Number of constant-rate steps a phase whose target_tps changes is split into by default
+DEFAULT_RAMP_STEPS = 5
+# Config keys run_timeline sets itself: phases run until stopped and alternate metrics ports
+TIMELINE_MANAGED_KEYS = ("ticks", "metrics_port")
+# Largest denominator kept when turning message mix weights into whole counts
+MESSAGE_MIX_RESOLUTION = 100
+DURATION_UNITS = {"s": 1, "m": 60, "h": 3600}
+
+# Searches for the highest target_tps the chain sustains: the rate is doubled until a step
+# breaks one of the thresholds, then bisected between the last passing and first failing rate.
+FIND_CAPACITY = 'FIND-CAPACITY'
+
+# Seconds between samples of the mempool and the client metrics while a capacity step runs
+CAPACITY_POLL_INTERVAL = 2
+# Mempool txs sampled per poll to measure how long txs wait to be included
+LATENCY_SAMPLE_SIZE = 20
+# Seconds to wait for the mempool to drain between capacity steps
+MEMPOOL_DRAIN_TIMEOUT = 120
+# Runs every combination of the values given for the sweep axes for a fixed duration and
+# reports throughput and latency of each as a matrix.
+SWEEP = 'SWEEP'
+SWEEP_AXES = ("message_types", "msgs_per_tx", "target_tps")
+# Seconds txs sampled at the end of a sweep cell get to be included before they are timed
+DEFAULT_LATENCY_GRACE = 30
+# A cell saturates the chain when it includes less than this fraction of what the client sent
+SATURATION_RATIO = 0.9
+SWEEP_COLUMNS = ("sent_tps", "chain_tps", "chain_msgs_per_second", "saturated", "p50_block_time_ms",
+                 "p95_block_time_ms", "p95_mempool_txs", "p50_inclusion_latency", "p95_inclusion_latency")
+
+# Seconds between scrapes of the metrics of fanned-out clients
+FANOUT_SCRAPE_INTERVAL = 10
+# Runs a fanned-out client with its own home holding only its slice of ~/test_accounts, since
+# the client loads the first max_accounts keys it finds there. Everything else in the home is
+# linked so the keyring and admin key are shared. Clients launch together at start_at (unix
+# seconds), so the start is synchronised across hosts as far as their clocks agree.
+FANOUT_CLIENT_SCRIPT = """
+set -e
+dir={dir}
+rm -rf "$dir"
+mkdir -p "$dir/test_accounts"
+for f in "$HOME"/* "$HOME"/.[!.]*; do
+    if [ -e "$f" ] && [ "${{f##*/}}" != test_accounts ]; then ln -s "$f" "$dir/"; fi
+done
+LC_ALL=C ls -A "$HOME/test_accounts" | sed -n '{first},{last}p' | while read -r f; do
+    ln -s "$HOME/test_accounts/$f" "$dir/test_accounts/$f"
+done
+cat > "$dir/config.json"
+while [ "$(date +%s)" -lt {start_at} ]; do sleep 0.1; done
+echo $$ > "$dir/pid"
+exec env HOME="$dir" {command}
+"""
+
 @dataclass
 class LoadTestConfig:
     config_file_path: str
     loadtest_binary_file_path: str
+    timeline_file_path: str = None
+    phases_output_path: str = None
+    capacity_search: "CapacitySearch" = None
+    fanout: "Fanout" = None
+    sweep_file_path: str = None
+    sweep_output_path: str = None
+
+
+@dataclass
+class CapacitySearch:
+    start_tps: int
+    max_tps: int
+    step_duration: float
+    warmup: float
+    resolution: float
+    max_block_time_ms: float
+    max_mempool_txs: int
+    max_inclusion_latency: float
+    min_send_ratio: float
+    output_path: str
+
+
+@dataclass
+class Fanout:
+    clients: int
+    hosts: list
+    start_delay: float
+    output_path: str
+
+
+@dataclass
+class Phase:
+    name: str
+    step: int
+    duration: float
+    config: dict = field(default_factory=dict)
+
+
+@dataclass
+class PhaseRecord:
+    name: str
+    step: int
+    target_tps: int
+    message_types: list
+    start: float = None
+    end: float = None
+    start_height: int = None
+    end_height: int = None
+    exit_code: int = None
 
 
 def write_to_temp_json_file(data):
@@ -74,17 +198,769 @@ def read_config_json(config_json_file_path):
         return json.load(file)
 
 
-def run_go_loadtest_client(config_file_path, binary_path):
+def loadtest_client_command(config_file_path, binary_path):
     # Default path for running on EC2 instances
     cmd = ["/home/ubuntu/sei-chain/build/loadtest", "-config-file", config_file_path]
     if binary_path is not None:
        cmd[0] = binary_path
+    return cmd
 
+
+def run_go_loadtest_client(config_file_path, binary_path):
+    cmd = loadtest_client_command(config_file_path, binary_path)
     print(f'Running {" ".join(cmd)}')
     subprocess.run(cmd, check=True)
 
+
+def parse_duration(value):
+    """
+    Seconds of a phase duration given as a number of seconds or a string like "90s", "5m", "1h".
+    """
+    if isinstance(value, (int, float)):
+        return float(value)
+    value = value.strip()
+    if value[-1:] in DURATION_UNITS:
+        return float(value[:-1]) * DURATION_UNITS[value[-1]]
+    return float(value)
+
+
+def message_types_for_mix(mix):
+    """
+    The Go client picks message types uniformly from message_types, so a weighted mix such as
+    {"bank": 3, "dex": 1} becomes a list repeating every type in proportion to its weight.
+    """
+    if isinstance(mix, list):
+        return mix
+    weights = {msg_type: Fraction(str(weight)).limit_denominator(MESSAGE_MIX_RESOLUTION)
+               for msg_type, weight in mix.items() if weight > 0}
+    if not weights:
+        raise ValueError(f"message mix {mix} has no positive weight")
+    denominator = math.lcm(*(weight.denominator for weight in weights.values()))
+    counts = {msg_type: int(weight * denominator) for msg_type, weight in weights.items()}
+    divisor = math.gcd(*counts.values())
+    return [msg_type for msg_type, count in counts.items() for _ in range(count // divisor)]
+
+
+def expand_timeline(timeline):
+    """
+    Turns a timeline into the phases to run. Each timeline phase has a duration, a target_tps
+    that is either constant or a [start, end] pair, an optional message mix and optional
+    config overrides on top of the timeline's "defaults". A phase whose target_tps changes is
+    run as `steps` constant-rate steps, since the client's rate is fixed for its lifetime.
+    The keys in TIMELINE_MANAGED_KEYS cannot be overridden.
+    """
+    defaults = timeline.get("defaults", {})
+    for key in TIMELINE_MANAGED_KEYS:
+        if key in defaults:
+            raise ValueError(f"timeline defaults: {key} is set by the timeline runner and cannot be overridden")
+    phases = []
+    for i, spec in enumerate(timeline["phases"]):
+        name = spec.get("name", f"phase-{i}")
+        duration = parse_duration(spec["duration"])
+        target_tps = spec["target_tps"]
+        start_tps, end_tps = (target_tps, target_tps) if isinstance(target_tps, (int, float)) else target_tps
+        if min(start_tps, end_tps) <= 0:
+            raise ValueError(f"phase {name}: target_tps must be positive")
+        steps = int(spec.get("steps", 1 if start_tps == end_tps else DEFAULT_RAMP_STEPS))
+        for key in TIMELINE_MANAGED_KEYS:
+            if key in spec.get("config", {}):
+                raise ValueError(f"phase {name}: {key} is set by the timeline runner and cannot be overridden")
+        config = dict(defaults)
+        config.update(spec.get("config", {}))
+        mix = spec.get("message_types", config.get("message_types"))
+        if mix is not None:
+            config["message_types"] = message_types_for_mix(mix)
+        for step in range(steps):
+            tps = start_tps + (end_tps - start_tps) * step / (steps - 1) if steps > 1 else start_tps
+            phases.append(Phase(name, step, duration / steps, dict(config, target_tps=max(1, round(tps)))))
+    return phases
+
+
+def rpc_get(blockchain_endpoint, path):
+    with urllib.request.urlopen(f"{blockchain_endpoint}{path}", timeout=5) as res:
+        body = json.load(res)
+    return body.get("result", body)
+
+
+def get_block_height(blockchain_endpoint):
+    """
+    Latest height of the node the client sends to, or None when it cannot be reached; only used
+    to tag phases with the blocks they produced.
+    """
+    try:
+        return int(rpc_get(blockchain_endpoint, "/status")["sync_info"]["latest_block_height"])
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+class ClientProcess:
+    """
+    A running Go loadtest client. Its output is echoed prefixed with `label`, and `ready` is
+    set once the client starts sending.
+    """
+
+    def __init__(self, label, cmd, stdin_text=None):
+        self.label = label
+        self.ready = threading.Event()
+        self.launched_at = time.time()
+        self.ready_at = None
+        self.process = subprocess.Popen(
+            cmd,
+            stdin=subprocess.PIPE if stdin_text is not None else None,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+        )
+        if stdin_text is not None:
+            self.process.stdin.write(stdin_text)
+            self.process.stdin.close()
+        self.reader = threading.Thread(target=self._read_output, daemon=True)
+        self.reader.start()
+
+    def _read_output(self):
+        prefix = f"[{self.label}]"
+        for line in self.process.stdout:
+            if not self.ready.is_set() and CLIENT_READY_MARKER in line:
+                self.ready_at = time.time()
+                self.ready.set()
+            print(f"{prefix} {line}", end="", flush=True)
+
+    def wait_ready(self, timeout):
+        """
+        Waits for the client to start sending; False if it exited or the timeout passed.
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        while not self.ready.wait(1):
+            if self.process.poll() is not None or (deadline is not None and time.time() >= deadline):
+                return self.ready.is_set()
+        return True
+
+    def interrupt(self):
+        self.process.send_signal(signal.SIGINT)
+
+    def stop(self):
+        if self.process.poll() is None:
+            self.interrupt()
+            try:
+                self.process.wait(CLIENT_STOP_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        self.reader.join()
+        return self.process.returncode
+
+
+class PhaseClient(ClientProcess):
+    """
+    A Go loadtest client running one phase of a timeline or capacity search.
+    """
+
+    def __init__(self, phase, config, binary_path):
+        self.phase = phase
+        self.config_file_path = write_to_temp_json_file(config)
+        super().__init__(f"{phase.name}#{phase.step}",
+                         loadtest_client_command(self.config_file_path, binary_path))
+
+    def stop(self):
+        returncode = super().stop()
+        os.remove(self.config_file_path)
+        return returncode
+
+
+class FanoutClient(ClientProcess):
+    """
+    One of several Go loadtest clients sharing a test, run locally or over SSH on `host` with
+    its own slice of the test accounts.
+    """
+
+    def __init__(self, index, host, config, first_account, start_at, binary_path):
+        self.index = index
+        self.host = host
+        self.config = config
+        self.dir = f"/tmp/loadtest-client-{index}"
+        script = FANOUT_CLIENT_SCRIPT.format(
+            dir=shlex.quote(self.dir),
+            first=first_account + 1,
+            last=first_account + config["max_accounts"],
+            start_at=int(start_at),
+            command=shlex.join(loadtest_client_command(f"{self.dir}/config.json", binary_path)),
+        )
+        super().__init__(f"client-{index}@{host or 'localhost'}", self._command(script), json.dumps(config))
+
+    def _command(self, script):
+        if self.host is None:
+            return ["sh", "-c", script]
+        return ["ssh", self.host, f"sh -c {shlex.quote(script)}"]
+
+    @property
+    def metrics_url(self):
+        # ssh hosts may be given as user@host
+        return f"http://{(self.host or 'localhost').rpartition('@')[2]}:{self.config['metrics_port']}/metrics"
+
+    def interrupt(self):
+        # Signalling ssh would not reach the remote client, so it is signalled through its pid file
+        subprocess.run(self._command(f'kill -INT "$(cat {shlex.quote(self.dir)}/pid)"'), check=False)
+
+    def stop(self):
+        returncode = super().stop()
+        subprocess.run(self._command(f"rm -rf {shlex.quote(self.dir)}"), check=False)
+        return returncode
+
+
+def partition_clients(config, fanout):
+    """
+    Splits a test config over the fanned-out clients: each gets a disjoint, contiguous slice of
+    the max_accounts test accounts, an equal share of target_tps and its own metrics_port.
+    Clients are spread round-robin over the hosts; None runs a client locally.
+    """
+    hosts = fanout.hosts or [None]
+    metrics_port = config.get("metrics_port") or 9696
+    if config["max_accounts"] < fanout.clients:
+        raise ValueError(f"max_accounts {config['max_accounts']} cannot be split over {fanout.clients} clients")
+    partitions = []
+    for i in range(fanout.clients):
+        first_account = config["max_accounts"] * i // fanout.clients
+        client_config = dict(
+            config,
+            max_accounts=config["max_accounts"] * (i + 1) // fanout.clients - first_account,
+            target_tps=max(1, config["target_tps"] * (i + 1) // fanout.clients - config["target_tps"] * i // fanout.clients),
+            metrics_port=metrics_port + i,
+        )
+        partitions.append((hosts[i % len(hosts)], client_config, first_account))
+    return partitions
+
+
+def sum_client_counts(samples):
+    """
+    Produced and sent txs per message type from a client's metrics samples.
+    """
+    counts = {}
+    for name, labels, value in samples:
+        kind = {"sei_loadtest_produce_count": "produced", "sei_loadtest_consume_count": "sent"}.get(name)
+        if kind is not None:
+            per_type = counts.setdefault(kind, {})
+            per_type[labels.get("msg_type", "")] = per_type.get(labels.get("msg_type", ""), 0) + value
+    return counts
+
+
+def aggregate_fanout(clients, first_snapshot, last_snapshot, chain):
+    """
+    Rates of every client and of all clients together between the first and last snapshot of
+    their metrics, next to the tps the chain itself included over the same window.
+    """
+    elapsed = last_snapshot[0] - first_snapshot[0]
+    per_client = []
+    total = {}
+    for client, first, last in zip(clients, first_snapshot[1], last_snapshot[1]):
+        rates = {}
+        for kind, per_type in last.items():
+            rates[kind] = {msg_type: (count - first.get(kind, {}).get(msg_type, 0)) / elapsed
+                           for msg_type, count in per_type.items()}
+            for msg_type, rate in rates[kind].items():
+                total.setdefault(kind, {})[msg_type] = total.get(kind, {}).get(msg_type, 0) + rate
+        per_client.append({
+            "client": client.label,
+            "max_accounts": client.config["max_accounts"],
+            "target_tps": client.config["target_tps"],
+            "tps": {kind: sum(per_type.values()) for kind, per_type in rates.items()},
+            "tps_by_msg_type": rates,
+        })
+    return {
+        "window": {"start": first_snapshot[0], "end": last_snapshot[0], "seconds": elapsed},
+        "total": {
+            "target_tps": sum(client.config["target_tps"] for client in clients),
+            "tps": {kind: sum(per_type.values()) for kind, per_type in total.items()},
+            "tps_by_msg_type": total,
+        },
+        "chain": chain,
+        "clients": per_client,
+    }
+
+
+def chain_throughput(blockchain_endpoint, start_height, end_height):
+    """
+    Txs the chain included per second between two heights, from the block headers.
+    """
+    if start_height is None or end_height is None or end_height <= start_height:
+        return None
+    metas = get_block_metas(blockchain_endpoint, start_height, end_height)
+    times = {height: parse_block_time(meta["header"]["time"]) for height, meta in metas.items()}
+    txs = sum(int(metas[height]["num_txs"]) for height in range(start_height + 1, end_height + 1) if height in metas)
+    return {
+        "start_height": start_height,
+        "end_height": end_height,
+        "txs": txs,
+        "tps": txs / (times[end_height] - times[start_height]) if times[end_height] > times[start_height] else None,
+    }
+
+
+def run_fanout(config, loadtest_config):
+    """
+    Runs the test with several clients at once so the load generator is not what limits it.
+    The clients launch together, the rates are measured from the moment every client is
+    sending until the first one stops, and the aggregate is written to the fanout output.
+    Only one admin account exists, so configs with admin messages can see sequence errors.
+    """
+    fanout = loadtest_config.fanout
+    endpoint = config.get("blockchain_endpoint", "http://localhost:26657")
+    start_at = time.time() + fanout.start_delay
+    clients = [
+        FanoutClient(i, host, client_config, first_account, start_at, loadtest_config.loadtest_binary_file_path)
+        for i, (host, client_config, first_account) in enumerate(partition_clients(config, fanout))
+    ]
+    snapshots = []
+    start_height = end_height = None
+    try:
+        for client in clients:
+            if not client.wait_ready(None):
+                raise RuntimeError(f"{client.label} exited before sending")
+        print(f"All {len(clients)} clients are sending")
+        start_height = get_block_height(endpoint)
+        while all(client.process.poll() is None for client in clients):
+            samples = [scrape_client_metrics(client.metrics_url) for client in clients]
+            if None not in samples:
+                snapshots.append((time.time(), [sum_client_counts(s) for s in samples]))
+                end_height = get_block_height(endpoint)
+            time.sleep(FANOUT_SCRAPE_INTERVAL)
+    except KeyboardInterrupt:
+        print("Interrupted, stopping the clients")
+    finally:
+        exit_codes = [client.stop() for client in clients]
+    if len(snapshots) < 2:
+        print("Clients did not run long enough to measure them")
+        return None
+    report = aggregate_fanout(clients, snapshots[0], snapshots[-1], chain_throughput(endpoint, start_height, end_height))
+    with open(fanout.output_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=4)
+    if any(code not in (0, -signal.SIGINT) for code in exit_codes):
+        raise RuntimeError(f"loadtest clients exited with {exit_codes}")
+    return report
+
+
+def write_phase_records(path, records):
+    """
+    Writes the phases finished so far as a JSON list of {name, start, end, ...} with unix
+    times, the format metrics.py --phases-file reads to tag txs by the phase they were sent in.
+    """
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump([record.__dict__ for record in records if record.end is not None], f, indent=4)
+
+
+def run_timeline(base_config, phases, loadtest_config):
+    """
+    Runs the phases back to back. The next phase's client is launched ahead of the end of the
+    current one by the last measured client startup time, and the current client is stopped
+    as soon as the next one starts sending, so the load never pauses between phases. Clients
+    of consecutive phases alternate between two metrics ports, counting from the base config's,
+    since they briefly overlap; expand_timeline rejects phase overrides of these keys.
+    """
+    endpoint = base_config.get("blockchain_endpoint", "http://localhost:26657")
+    metrics_port = base_config.get("metrics_port") or 9696
+    records = []
+    startup_seconds = DEFAULT_CLIENT_STARTUP_SECONDS
+
+    running = []
+
+    def launch(i):
+        phase = phases[i]
+        config = {**base_config, **phase.config, "ticks": 0, "metrics_port": metrics_port + i % 2}
+        print(f"Launching phase {phase.name}#{phase.step}: target_tps={config['target_tps']} "
+              f"for {phase.duration:.0f}s")
+        running.append(PhaseClient(phase, config, loadtest_config.loadtest_binary_file_path))
+        return running[-1]
+
+    def start(client):
+        record = PhaseRecord(client.phase.name, client.phase.step, client.phase.config["target_tps"],
+                             client.phase.config.get("message_types", base_config.get("message_types")),
+                             start=client.ready_at, start_height=get_block_height(endpoint))
+        records.append(record)
+        return record
+
+    def finish(client, record, end):
+        running.remove(client)
+        record.end = end
+        record.end_height = get_block_height(endpoint)
+        # Stop in the background so a slow shutdown does not delay the next phase's timer
+        def stop():
+            record.exit_code = client.stop()
+        stopper = threading.Thread(target=stop)
+        stopper.start()
+        return stopper
+
+    current = launch(0)
+    stoppers = []
+    try:
+        if not current.wait_ready(None):
+            raise RuntimeError(f"loadtest client of phase {phases[0].name} exited before sending")
+        startup_seconds = current.ready_at - current.launched_at
+        record = start(current)
+        for i in range(1, len(phases) + 1):
+            end_at = record.start + current.phase.duration
+            if i == len(phases):
+                time.sleep(max(0.0, end_at - time.time()))
+                stoppers.append(finish(current, record, time.time()))
+                break
+            time.sleep(max(0.0, end_at - startup_seconds - time.time()))
+            following = launch(i)
+            # The current client keeps the load up until the next one is sending, however long it takes
+            if not following.wait_ready(None):
+                running.remove(following)
+                following.stop()
+                stoppers.append(finish(current, record, time.time()))
+                raise RuntimeError(f"loadtest client of phase {phases[i].name} exited before sending")
+            startup_seconds = following.ready_at - following.launched_at
+            stoppers.append(finish(current, record, following.ready_at))
+            current, record = following, start(following)
+            if loadtest_config.phases_output_path:
+                write_phase_records(loadtest_config.phases_output_path, records)
+    except KeyboardInterrupt:
+        print("Interrupted, stopping the running phase")
+        if records and records[-1].end is None:
+            stoppers.append(finish(current, records[-1], time.time()))
+    finally:
+        for client in list(running):
+            running.remove(client)
+            client.stop()
+        for stopper in stoppers:
+            stopper.join()
+        if loadtest_config.phases_output_path:
+            write_phase_records(loadtest_config.phases_output_path, records)
+    failed = [record for record in records if record.exit_code not in (0, -signal.SIGINT, None)]
+    if failed:
+        raise RuntimeError(f"loadtest client failed in phases {', '.join(r.name for r in failed)}")
+    return records
+
+def parse_block_time(value):
+    """
+    Unix time of an RFC 3339 block time; Tendermint uses nanoseconds, which fromisoformat does not take.
+    """
+    date, _, fraction = value.rstrip("Z").partition(".")
+    return datetime.fromisoformat(date).replace(tzinfo=timezone.utc).timestamp() + float(f"0.{fraction or 0}")
+
+
+def get_block_metas(blockchain_endpoint, start_height, end_height):
+    """
+    /blockchain block meta of every height in [start_height, end_height].
+    """
+    block_metas = {}
+    max_height = end_height
+    while max_height >= start_height:
+        metas = rpc_get(blockchain_endpoint, f"/blockchain?minHeight={start_height}&maxHeight={max_height}")["block_metas"]
+        if not metas:
+            break
+        for meta in metas:
+            block_metas[int(meta["header"]["height"])] = meta
+        max_height = min(block_metas) - 1
+    return block_metas
+
+
+def get_block_times(blockchain_endpoint, start_height, end_height):
+    """
+    Block time of every height in [start_height, end_height].
+    """
+    return {height: parse_block_time(meta["header"]["time"])
+            for height, meta in get_block_metas(blockchain_endpoint, start_height, end_height).items()}
+
+
+def scrape_client_metrics(metrics_url):
+    """
+    (name, labels, value) of every sample a loadtest client exports, or None if it cannot be reached.
+    """
+    try:
+        with urllib.request.urlopen(metrics_url, timeout=5) as res:
+            lines = res.read().decode().splitlines()
+    except OSError:
+        return None
+    samples = []
+    for line in lines:
+        if line and not line.startswith("#"):
+            series, value = line.rsplit(" ", 1)
+            name, _, labels = series.partition("{")
+            samples.append((name, dict(re.findall(r'(\w+)="([^"]*)"', labels)), float(value)))
+    return samples
+
+
+def scrape_client_metric(metrics_url, name):
+    """
+    Sum over all labels of a metric a loadtest client exports, or None if the client has not
+    exported it (yet) or cannot be reached.
+    """
+    values = [value for sample_name, _, value in scrape_client_metrics(metrics_url) or [] if sample_name == name]
+    return sum(values) if values else None
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q / 100 * len(values)))]
+
+
+class MempoolSampler:
+    """
+    Samples txs waiting in the node's mempool and records when they are first seen, then looks
+    them up until they are included so their wait can be timed against the block time.
+    """
+
+    def __init__(self, blockchain_endpoint):
+        self.blockchain_endpoint = blockchain_endpoint
+        self.first_seen = {}
+        self.heights = {}
+        self.depths = []
+
+    def poll(self):
+        try:
+            unconfirmed = rpc_get(self.blockchain_endpoint, f"/unconfirmed_txs?per_page={LATENCY_SAMPLE_SIZE}")
+        except (OSError, ValueError):
+            return
+        self.depths.append(int(unconfirmed["total"]))
+        now = time.time()
+        for tx in unconfirmed["txs"] or []:
+            self.first_seen.setdefault(hashlib.sha256(base64.b64decode(tx)).hexdigest().upper(), now)
+        for tx_hash in [h for h in self.first_seen if h not in self.heights]:
+            try:
+                self.heights[tx_hash] = int(rpc_get(self.blockchain_endpoint, f"/tx?hash=0x{tx_hash}")["height"])
+            except (OSError, ValueError, KeyError):
+                # Not included (or indexed) yet
+                pass
+
+    def latencies(self, block_times, end):
+        """
+        Seconds from first sight in the mempool to inclusion of every sampled tx; txs still
+        waiting count the time they have waited so far.
+        """
+        return [block_times[self.heights[h]] - seen if h in self.heights and self.heights[h] in block_times
+                else end - seen for h, seen in self.first_seen.items()]
+
+
+def measure_load(config, label, duration, warmup, latency_grace, binary_path):
+    """
+    Runs the client with config for duration after warmup and measures the chain while it
+    does: block times, mempool depth, mempool-to-inclusion latency, the rate the client really
+    sent at and the rate the chain included txs at.
+    """
+    endpoint = config.get("blockchain_endpoint", "http://localhost:26657")
+    metrics_port = config.get("metrics_port") or 9696
+    metrics_url = f"http://localhost:{metrics_port}/metrics"
+    phase = Phase(label, 0, duration, {"target_tps": config["target_tps"]})
+    client = PhaseClient(phase, dict(config, ticks=0, metrics_port=metrics_port), binary_path)
+    sampler = MempoolSampler(endpoint)
+    try:
+        if not client.wait_ready(None):
+            raise RuntimeError(f"loadtest client of {label} exited before sending")
+        time.sleep(warmup)
+        start, start_height = time.time(), get_block_height(endpoint)
+        start_sent = scrape_client_metric(metrics_url, "sei_loadtest_consume_count")
+        while time.time() < start + duration:
+            if client.process.poll() is not None:
+                raise RuntimeError(f"loadtest client of {label} exited")
+            sampler.poll()
+            time.sleep(CAPACITY_POLL_INTERVAL)
+        end, end_height = time.time(), get_block_height(endpoint)
+        end_sent = scrape_client_metric(metrics_url, "sei_loadtest_consume_count")
+    finally:
+        client.stop()
+    # Give txs sampled late in the run time to be included before timing them
+    deadline = time.time() + latency_grace
+    while len(sampler.heights) < len(sampler.first_seen) and time.time() < deadline:
+        time.sleep(CAPACITY_POLL_INTERVAL)
+        sampler.poll()
+    latest_height = get_block_height(endpoint)
+    block_times = get_block_times(endpoint, start_height, latest_height)
+    intervals = [(block_times[h] - block_times[h - 1]) * 1000 for h in range(start_height + 1, end_height + 1)
+                 if h in block_times and h - 1 in block_times]
+    latencies = sampler.latencies(block_times, time.time())
+    chain = chain_throughput(endpoint, start_height, end_height)
+    return {
+        "target_tps": config["target_tps"],
+        "start": start,
+        "end": end,
+        "start_height": start_height,
+        "end_height": end_height,
+        "sent_tps": (end_sent - start_sent) / (end - start) if None not in (start_sent, end_sent) else None,
+        "chain_tps": chain["tps"] if chain else None,
+        "p50_block_time_ms": percentile(intervals, 50),
+        "p95_block_time_ms": percentile(intervals, 95),
+        "p95_mempool_txs": percentile(sampler.depths, 95),
+        "p50_inclusion_latency": percentile(latencies, 50),
+        "p95_inclusion_latency": percentile(latencies, 95),
+    }
+
+
+def run_capacity_step(base_config, target_tps, loadtest_config):
+    """
+    Runs the client at target_tps for one step and checks the measurements against the thresholds.
+    """
+    search = loadtest_config.capacity_search
+    # Txs get the latency budget to be included before they count as too slow
+    result = measure_load(dict(base_config, target_tps=target_tps), f"capacity-{target_tps}", search.step_duration,
+                          search.warmup, search.max_inclusion_latency, loadtest_config.loadtest_binary_file_path)
+    result["violations"] = capacity_violations(result, search)
+    return result
+
+
+def capacity_violations(result, search):
+    """
+    The thresholds a step broke; measurements that could not be taken are not held against it.
+    """
+    checks = [
+        ("block time", result["p95_block_time_ms"], search.max_block_time_ms),
+        ("mempool depth", result["p95_mempool_txs"], search.max_mempool_txs),
+        ("inclusion latency", result["p95_inclusion_latency"], search.max_inclusion_latency),
+    ]
+    violations = [f"p95 {name} {value:.1f} > {limit}" for name, value, limit in checks
+                  if value is not None and value > limit]
+    if result["sent_tps"] is not None and result["sent_tps"] < search.min_send_ratio * result["target_tps"]:
+        violations.append(f"client only sent {result['sent_tps']:.1f} tps")
+    return violations
+
+
+def wait_for_mempool_drain(blockchain_endpoint):
+    deadline = time.time() + MEMPOOL_DRAIN_TIMEOUT
+    while time.time() < deadline:
+        try:
+            if int(rpc_get(blockchain_endpoint, "/num_unconfirmed_txs")["total"]) == 0:
+                return
+        except (OSError, ValueError, KeyError):
+            return
+        time.sleep(CAPACITY_POLL_INTERVAL)
+    print(f"Mempool still not empty after {MEMPOOL_DRAIN_TIMEOUT}s, continuing")
+
+
+def find_capacity(base_config, loadtest_config):
+    """
+    Finds the highest target_tps at which every threshold holds: the rate doubles from
+    start_tps until a step fails (or max_tps is reached), then the range between the highest
+    passing and lowest failing rate is bisected until it is within the resolution.
+    """
+    search = loadtest_config.capacity_search
+    endpoint = base_config.get("blockchain_endpoint", "http://localhost:26657")
+    if get_block_height(endpoint) is None:
+        raise RuntimeError(f"cannot reach the node at {endpoint} to measure it")
+    steps = []
+    passing, failing = 0, None
+
+    def run_step(target_tps):
+        nonlocal passing, failing
+        print(f"Capacity step: target_tps={target_tps} for {search.step_duration:.0f}s")
+        result = run_capacity_step(base_config, target_tps, loadtest_config)
+        steps.append(result)
+        print(f"target_tps={target_tps}: {'; '.join(result['violations']) or 'sustained'}")
+        if result["violations"]:
+            failing = target_tps
+        else:
+            passing = target_tps
+        wait_for_mempool_drain(endpoint)
+        with open(search.output_path, "w", encoding="utf-8") as f:
+            json.dump({"max_sustainable_tps": passing, "search": search.__dict__, "steps": steps}, f, indent=4)
+
+    target_tps = search.start_tps or base_config["target_tps"]
+    while failing is None and passing < search.max_tps:
+        run_step(min(target_tps, search.max_tps))
+        target_tps *= 2
+    while failing is not None and failing - passing > max(1, failing * search.resolution):
+        run_step((passing + failing) // 2)
+    return passing, steps
+
+
+def expand_sweep(sweep):
+    """
+    The cells of a sweep: every combination of the values of its axes, applied on top of the
+    sweep's "defaults". message_types values are a type, a list of types or a weighted mix.
+    """
+    axes = sweep["axes"]
+    unknown = set(axes) - set(SWEEP_AXES)
+    if unknown:
+        raise ValueError(f"cannot sweep {', '.join(sorted(unknown))}; axes are {', '.join(SWEEP_AXES)}")
+    names = [axis for axis in SWEEP_AXES if axis in axes]
+    values = [[[value] if axis == "message_types" and isinstance(value, str) else value for value in axes[axis]]
+              for axis in names]
+    cells = []
+    for combination in itertools.product(*values):
+        cell = dict(zip(names, combination))
+        if "message_types" in cell:
+            cell["message_types"] = message_types_for_mix(cell["message_types"])
+        cells.append(cell)
+    return cells
+
+
+def describe_message_types(message_types):
+    """
+    Short name of a message mix, e.g. "bank*3+dex" for ["bank", "bank", "bank", "dex"].
+    """
+    counts = {}
+    for msg_type in message_types:
+        counts[msg_type] = counts.get(msg_type, 0) + 1
+    return "+".join(f"{msg_type}*{count}" if count > 1 else msg_type for msg_type, count in counts.items())
+
+
+def write_sweep_report(output_path, axes, rows):
+    with open(f"{output_path}.json", "w", encoding="utf-8") as f:
+        json.dump({"axes": axes, "cells": rows}, f, indent=4)
+    with open(f"{output_path}.csv", "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(axes + list(SWEEP_COLUMNS))
+        for row in rows:
+            cell = [describe_message_types(row[axis]) if axis == "message_types" else row[axis] for axis in axes]
+            writer.writerow(cell + [row[column] for column in SWEEP_COLUMNS])
+
+
+def run_sweep(base_config, sweep, loadtest_config):
+    """
+    Runs every cell of the sweep for its duration, one after the other with the mempool
+    drained in between, and rewrites the matrix report after each so an interrupted sweep
+    keeps what it measured.
+    """
+    config = dict(base_config, **sweep.get("defaults", {}))
+    endpoint = config.get("blockchain_endpoint", "http://localhost:26657")
+    duration = parse_duration(sweep["duration"])
+    warmup = parse_duration(sweep.get("warmup", 0))
+    latency_grace = parse_duration(sweep.get("latency_grace", DEFAULT_LATENCY_GRACE))
+    cells = expand_sweep(sweep)
+    axes = [axis for axis in SWEEP_AXES if axis in sweep["axes"]]
+    if get_block_height(endpoint) is None:
+        raise RuntimeError(f"cannot reach the node at {endpoint} to measure it")
+    rows = []
+    for i, cell in enumerate(cells):
+        label = ", ".join(f"{axis}={describe_message_types(cell[axis]) if axis == 'message_types' else cell[axis]}"
+                          for axis in axes)
+        print(f"Sweep cell {i + 1}/{len(cells)}: {label} for {duration:.0f}s")
+        result = measure_load(dict(config, **cell), f"cell-{i + 1}", duration, warmup, latency_grace,
+                              loadtest_config.loadtest_binary_file_path)
+        msgs_per_tx = dict(config, **cell).get("msgs_per_tx") or 1
+        result["chain_msgs_per_second"] = result["chain_tps"] * msgs_per_tx if result["chain_tps"] is not None else None
+        result["saturated"] = (result["chain_tps"] < SATURATION_RATIO * result["sent_tps"]
+                               if None not in (result["chain_tps"], result["sent_tps"]) else None)
+        rows.append({**{axis: cell[axis] for axis in axes}, **result})
+        print(f"{label}: sent {result['sent_tps'] or 0:.1f} tps, chain {result['chain_tps'] or 0:.1f} tps"
+              + (", saturated" if result["saturated"] else ""))
+        write_sweep_report(loadtest_config.sweep_output_path, axes, rows)
+        wait_for_mempool_drain(endpoint)
+    return rows
+
+
 def run_test(test_type, loadtest_config):
     config = base_config_json = read_config_json(loadtest_config.config_file_path)
+    if test_type == TIMELINE:
+        with open(loadtest_config.timeline_file_path, 'r', encoding="utf-8") as file:
+            phases = expand_timeline(json.load(file))
+        records = run_timeline(base_config_json, phases, loadtest_config)
+        for record in records:
+            print(f'phase {record.name}#{record.step}: target_tps={record.target_tps} '
+                  f'{record.end - record.start:.0f}s, blocks {record.start_height}-{record.end_height}')
+        return
+    if test_type == SWEEP:
+        with open(loadtest_config.sweep_file_path, 'r', encoding="utf-8") as file:
+            run_sweep(base_config_json, json.load(file), loadtest_config)
+        print(f'Wrote {loadtest_config.sweep_output_path}.csv and {loadtest_config.sweep_output_path}.json')
+        return
+    if test_type == FIND_CAPACITY:
+        capacity, _ = find_capacity(base_config_json, loadtest_config)
+        if capacity:
+            print(f'Max sustainable target_tps: {capacity}')
+        else:
+            print('No sustainable target_tps found')
+        return
     if test_type == BURST:
         config = create_burst_loadtest_config(base_config_json)
     elif test_type == STEADY:
@@ -92,6 +968,13 @@ def run_test(test_type, loadtest_config):
     elif test_type == CONTINUOUS:
         config = create_continuous_loadtest_config(base_config_json)
 
+    if loadtest_config.fanout is not None and (loadtest_config.fanout.clients > 1 or loadtest_config.fanout.hosts):
+        report = run_fanout(config, loadtest_config)
+        if report is not None:
+            print(f'{len(report["clients"])} clients sent {report["total"]["tps"].get("sent", 0):.1f} tps'
+                  + (f', chain included {report["chain"]["tps"]:.1f} tps' if report["chain"] and report["chain"]["tps"] else ''))
+        return
+
     temp_file_path = write_to_temp_json_file(config)
     try:
         run_go_loadtest_client(temp_file_path, binary_path=loadtest_config.loadtest_binary_file_path)
@@ -104,9 +987,9 @@ def run():
                         description = 'Wrapper for the golang client to run loadtests with different configs')
     parser.add_argument(
         'type',
-        help='Type of loadtest to run (e.g steady, burst, continuous)',
+        help='Type of loadtest to run (e.g steady, burst, continuous, timeline, find-capacity, sweep)',
         type = lambda s : s.upper(),
-        choices=[BURST, STEADY, CONTINUOUS],
+        choices=[BURST, STEADY, CONTINUOUS, TIMELINE, FIND_CAPACITY, SWEEP],
     )
     parser.add_argument(
         '--config-file',
@@ -118,14 +1001,92 @@ def run():
         help='binary of the loadtest client to run',
         required=False,
     )
+    parser.add_argument(
+        '--timeline-file',
+        help='JSON timeline of phases to run for the timeline type',
+        required=False,
+    )
+    parser.add_argument(
+        '--phases-output',
+        help='Where the timeline type writes the start, end and blocks of every phase',
+        default=os.path.expanduser('~/outputs/phases.json'),
+    )
+
+    parser.add_argument(
+        '--sweep-file',
+        help='JSON sweep over message_types, msgs_per_tx and target_tps for the sweep type',
+        required=False,
+    )
+    parser.add_argument(
+        '--sweep-output',
+        help='Path prefix of the .csv and .json matrix the sweep type writes',
+        default=os.path.expanduser('~/outputs/sweep'),
+    )
+    fanout = parser.add_argument_group('fan-out')
+    fanout.add_argument('--clients', type=int, default=1,
+                        help='Number of client processes sharing the test, each with a disjoint slice of '
+                             'max_accounts, an equal share of target_tps and its own metrics_port')
+    fanout.add_argument('--hosts', type=lambda s: s.split(','), default=[],
+                        help='Comma-separated SSH hosts to run the clients on, round-robin '
+                             '(blockchain_endpoint must be reachable from them)')
+    fanout.add_argument('--start-delay', type=float, default=10.0,
+                        help='Seconds from now at which all clients launch together')
+    fanout.add_argument('--fanout-output', default=os.path.expanduser('~/outputs/fanout.json'),
+                        help='Where the aggregated metrics of the clients are written')
+    capacity = parser.add_argument_group('find-capacity')
+    capacity.add_argument('--start-tps', type=int, help='First target_tps tried (default: target_tps of the config)')
+    capacity.add_argument('--max-tps', type=int, default=100000, help='Highest target_tps tried')
+    capacity.add_argument('--step-duration', type=parse_duration, default=60.0,
+                          help='How long every rate is measured, e.g. 60s or 5m')
+    capacity.add_argument('--warmup', type=parse_duration, default=10.0,
+                          help='How long a rate runs before it is measured')
+    capacity.add_argument('--resolution', type=float, default=0.05,
+                          help='Stop once the failing and passing rates are this fraction of the rate apart')
+    capacity.add_argument('--max-block-time-ms', type=float, default=1000.0, help='Highest p95 block time')
+    capacity.add_argument('--max-mempool-txs', type=int, default=5000, help='Highest p95 mempool depth')
+    capacity.add_argument('--max-inclusion-latency', type=float, default=5.0,
+                          help='Highest p95 seconds from the mempool to a block')
+    capacity.add_argument('--min-send-ratio', type=float, default=0.9,
+                          help='Lowest fraction of target_tps the client has to send for a rate to count')
+    capacity.add_argument('--capacity-output', default=os.path.expanduser('~/outputs/capacity.json'),
+                          help='Where the steps of the search and the result are written')
 
     args = parser.parse_args()
+    if args.type == TIMELINE and args.timeline_file is None:
+        parser.error('the timeline type needs --timeline-file')
+    if args.type == SWEEP and args.sweep_file is None:
+        parser.error('the sweep type needs --sweep-file')
     test_type = args.type
     print(f'type={test_type} loadtests')
 
     run_test(
         test_type=test_type,
-        loadtest_config=LoadTestConfig(args.config_file, args.loadtest_binary)
+        loadtest_config=LoadTestConfig(
+            args.config_file,
+            args.loadtest_binary,
+            args.timeline_file,
+            args.phases_output,
+            CapacitySearch(
+                args.start_tps,
+                args.max_tps,
+                args.step_duration,
+                args.warmup,
+                args.resolution,
+                args.max_block_time_ms,
+                args.max_mempool_txs,
+                args.max_inclusion_latency,
+                args.min_send_ratio,
+                args.capacity_output,
+            ),
+            Fanout(
+                max(args.clients, len(args.hosts)),
+                args.hosts,
+                args.start_delay,
+                args.fanout_output,
+            ),
+            args.sweep_file,
+            args.sweep_output,
+        )
     )
 
 
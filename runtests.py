@@ -1,52 +1,1442 @@
-import multiprocessing
+import argparse
+import hashlib
+import functools
+import heapq
+import json
+import math
 import os
+import queue
+import re
+import resource
+import shutil
+import signal
+import sqlite3
+import statistics
+import subprocess
 import sys
+import tempfile
+import threading
+import time
+import xml.etree.ElementTree as ET
+from collections import deque
+from dataclasses import dataclass, replace
+from datetime import datetime, timezone
 
+# Directory holding state carried between runs, relative to the repository root
+STATE_DIR = ".runtests"
+# Per-package wall time of previous runs, used to schedule the slowest packages first
+DURATIONS_FILE = os.path.join(STATE_DIR, "durations.json")
+# Number of past runs kept per package when estimating its duration
+DURATION_HISTORY_SIZE = 5
+# Import graph of the go.work modules, refreshed incrementally and used by --since
+GRAPH_FILE = os.path.join(STATE_DIR, "graph.json")
+# Bump whenever the layout of GRAPH_FILE changes
+GRAPH_VERSION = 1
+# Bump whenever the inputs of the package hashes used by the result cache change
+RESULT_CACHE_VERSION = 2
+# Per-package and per-test timings of the last run, also the baseline of the next run's diff
+REPORT_FILE = os.path.join(STATE_DIR, "report.json")
+# Tests whose duration changed by less than this many seconds are left out of the timing diff
+TIMING_DIFF_MIN_SECONDS = 0.1
+# How often the scheduler re-evaluates load, memory and timeouts while waiting for packages
+SCHEDULER_POLL_SECONDS = 0.5
+# Most packages built by one go test -c invocation in --compile-first mode
+COMPILE_BATCH_SIZE = 32
+# Per-test run, failure and flake counts across runs, used to quarantine known-flaky tests
+FLAKES_FILE = os.path.join(STATE_DIR, "flakes.json")
+# Flakes a test needs before it can be quarantined, so one unlucky run is not enough
+QUARANTINE_MIN_FLAKES = 2
+# Benchmark history of --bench runs
+BENCH_DB_FILE = os.path.join(STATE_DIR, "bench.sqlite")
+# Packages benchmarked by --bench unless --bench-packages is given; they cover the storage,
+# OCC and EVM hot paths
+DEFAULT_BENCH_PACKAGES = ["sei-db/...", "store/...", "occ_tests/...", "x/evm/..."]
+# Significance level of the Mann-Whitney U test, the benchstat default
+BENCH_ALPHA = 0.05
+# Samples per side up to which the exact U distribution is used instead of the normal approximation
+BENCH_EXACT_MAX_SAMPLES = 20
+# A benchmark result line, e.g. "BenchmarkWrite-8   1000   1234 ns/op   56 B/op   7 allocs/op"
+BENCH_LINE = re.compile(r"^(Benchmark\S+?)(?:-\d+)?\s+\d+\s+(.+)$")
+BENCH_METRIC = re.compile(r"(\d+(?:\.\d+)?(?:[eE][-+]?\d+)?)\s+(\S+)")
+# Lower-is-better units that are compared against the baseline; MB/s and b.ReportMetric units
+# are recorded but not compared, as their direction is not known
+BENCH_COMPARED_UNITS = ("ns/op", "B/op", "allocs/op")
+# Directory names never searched for packages, besides hidden and _-prefixed ones like the go tool
+EXCLUDED_DIRS = ("testdata", "vendor", "node_modules")
 
-def call_proc(cmd):
-    """ This runs in a separate thread. """
-    #subprocess.call(shlex.split(cmd))  # This will block until cmd finishes
-    stream = os.popen(cmd)
-    return stream.read()
 
-def get_directories_with_go_test():
-    stream = os.popen("find . -type f -name '*_test.go*' | sed -E 's|/[^/]+$||' |uniq")
-    output = stream.read()
-    # exclude ./ in the beginning of the filepath
-    return [path[2:] for path in output.split("\n") if path]
+@dataclass
+class WorkerBudget:
+    # CPUs of this machine the tests may use
+    cpus: int
+    # GOMAXPROCS and go build -p parallelism given to each package
+    cpus_per_job: int
+    # Free memory required before another package is started
+    memory_per_job: int
+    # Upper bound on concurrently running packages
+    max_jobs: int
+    # Seconds after which a package is killed
+    timeout: float
+
+    def env(self):
+        return dict(os.environ, GOMAXPROCS=str(self.cpus_per_job))
+
+class JobSlots:
+    """
+    Worker slots shared between schedulers, so that the compile and execution schedulers of
+    --compile-first together stay within max_jobs. The first job always gets a slot.
+    """
+
+    def __init__(self, max_jobs):
+        self.max_jobs = max_jobs
+        self.used = 0
+        self.peak = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self.used and self.used >= self.max_jobs:
+                return False
+            self.used += 1
+            self.peak = max(self.peak, self.used)
+            return True
+
+    def release(self):
+        with self._lock:
+            self.used -= 1
+
+def collect_test_events(lines):
+    """
+    Consumes the output of go test -json. Returns the output worth printing (package level
+    output, the output of failed tests and anything that is not a test event) and the
+    status and duration of every test. The output of a passing test is dropped as soon as
+    it finishes, so memory is bounded by the tests still running.
+    """
+    output = []
+    tests = {}
+    running = {}
+    for line in lines:
+        try:
+            event = json.loads(line)
+        except ValueError:
+            event = None
+        if not isinstance(event, dict) or "Action" not in event:
+            output.append(line)
+            continue
+        test = event.get("Test")
+        action = event["Action"]
+        if test is None:
+            # Package level output, including build-output events of packages that do not compile
+            output.append(event.get("Output", ""))
+        elif action == "output":
+            running.setdefault(test, []).append(event["Output"])
+        elif action in ("pass", "fail", "skip"):
+            test_output = running.pop(test, [])
+            tests[test] = {"status": action, "duration": event.get("Elapsed", 0.0)}
+            if action == "fail":
+                tests[test]["output"] = "".join(test_output)
+                output.extend(test_output)
+    # Tests that never finished because the test binary panicked or timed out
+    for test, test_output in running.items():
+        tests[test] = {"status": "fail", "duration": 0.0, "output": "".join(test_output)}
+        output.extend(test_output)
+    return "".join(output), tests
+
+def usable_cpus():
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+def available_memory():
+    """ MemAvailable in bytes, or None where /proc/meminfo does not exist. """
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def can_start_job(running, budget):
+    """
+    A package may start while the worker limit is not reached, the machine is not
+    already saturated (1 minute load average below the CPU count) and there is enough
+    free memory. The first package always starts so the run cannot stall.
+    """
+    if running == 0:
+        return True
+    if running >= budget.max_jobs:
+        return False
+    if os.getloadavg()[0] >= budget.cpus:
+        return False
+    memory = available_memory()
+    return memory is None or memory >= budget.memory_per_job
+
+def collect_job(dir, proc, completions):
+    """ This runs in a separate thread per package. """
+    output, tests = collect_test_events(proc.stdout)
+    completions.put((dir, proc.wait(), output, tests))
+
+def kill_job(proc):
+    # The go test process runs in its own session, so the whole group has to be killed
+    # explicitly or test binaries would outlive it.
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+def closed_feed(jobs):
+    """ A job feed for run_packages that already holds every job. """
+    feed = queue.Queue()
+    for job in jobs:
+        feed.put(job)
+    feed.put(None)
+    return feed
+
+def run_packages(feed, budget, stats, cancelled=None, follow_ups=None, slots=None):
+    """
+    Runs the (key, command) jobs taken from the feed queue, in order and within the worker
+    budget, and yields (key, returncode, output, tests, duration) as they finish. The feed
+    may still be filled by another thread; None marks its end. Jobs the caller appends to
+    the follow_ups deque while handling a result run before the rest of the feed. Jobs
+    running longer than the budget's timeout are killed. Closing the generator, or setting
+    cancelled, kills everything still running. Every job also takes one of the slots, which
+    other schedulers may share.
+    """
+    slots = JobSlots(budget.max_jobs) if slots is None else slots
+    closed = False
+    running = {}
+    # Processes killed for exceeding the timeout; a retry of the same package is a new process
+    killed = set()
+    completions = queue.Queue()
+    follow_ups = deque() if follow_ups is None else follow_ups
+    try:
+        while (not closed or running or follow_ups) and not (cancelled and cancelled.is_set()):
+            while (follow_ups or not closed) and can_start_job(len(running), budget) and slots.acquire():
+                if follow_ups:
+                    job = follow_ups.popleft()
+                else:
+                    try:
+                        job = feed.get_nowait()
+                    except queue.Empty:
+                        slots.release()
+                        break
+                    if job is None:
+                        closed = True
+                        slots.release()
+                        continue
+                key, cmd = job
+                proc = subprocess.Popen(
+                    cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True,
+                    start_new_session=True, env=budget.env(),
+                )
+                running[key] = (proc, time.monotonic())
+                threading.Thread(target=collect_job, args=(key, proc, completions), daemon=True).start()
+                stats["peak_jobs"] = max(stats["peak_jobs"], len(running))
+            if not feed.empty() and len(running) < budget.max_jobs:
+                stats["throttled_polls"] += 1
+
+            now = time.monotonic()
+            for key, (proc, started) in running.items():
+                if now - started > budget.timeout and proc not in killed:
+                    killed.add(proc)
+                    stats["timed_out"].add(key)
+                    kill_job(proc)
+            try:
+                key, returncode, output, tests = completions.get(timeout=SCHEDULER_POLL_SECONDS)
+            except queue.Empty:
+                continue
+            proc, started = running.pop(key)
+            slots.release()
+            duration = time.monotonic() - started
+            stats["busy_seconds"] += duration
+            if proc in killed:
+                killed.discard(proc)
+                output += f"\nruntests.py: killed after exceeding the {budget.timeout:g}s package timeout\n"
+            yield key, returncode, output, tests, duration
+    finally:
+        for proc, _ in running.values():
+            kill_job(proc)
+            slots.release()
+
+def new_scheduler_stats():
+    return {"peak_jobs": 0, "busy_seconds": 0.0, "throttled_polls": 0, "timed_out": set()}
+
+def module_root(root, dir):
+    """ The closest directory at or above dir holding a go.mod. """
+    module = dir
+    while not os.path.exists(os.path.join(root, module, "go.mod")):
+        if module == ".":
+            return None
+        module = os.path.dirname(module) or "."
+    return module
+
+def read_module_path(root, module):
+    with open(os.path.join(root, module, "go.mod"), "r", encoding="utf-8") as f:
+        for line in f:
+            if line.startswith("module "):
+                return line.split()[1].strip('"')
+    raise ValueError(f"{module}/go.mod has no module directive")
+
+def test_binary_name(import_path):
+    """ The name go test -c gives a package's test binary, following the go tool's DefaultExecName. """
+    elems = import_path.split("/")
+    elem = elems[-1]
+    # A major version suffix as in isVersionElement: v2, v3, ... but not v0, v1 or v01
+    if len(elems) > 1 and re.fullmatch(r"v[1-9][0-9]*", elem) and elem != "v1":
+        elem = elems[-2]
+    return f"{elem}.test"
+
+def plan_compile_batches(root, dirs, bin_dir):
+    """
+    Groups the packages by go module into batches of at most COMPILE_BATCH_SIZE packages
+    whose test binaries have distinct names, as go test -c refuses to write two binaries
+    with the same name into one directory. Packages keep their scheduling order.
+    Returns [(module, batch output dir, [(dir, import path, binary path)])].
+    """
+    batches = []
+    open_batches = {}
+    module_paths = {}
+    for dir in dirs:
+        module = module_root(root, dir)
+        if module not in module_paths:
+            module_paths[module] = read_module_path(root, module)
+        rel = os.path.relpath(dir, module)
+        import_path = module_paths[module] if rel == "." else f"{module_paths[module]}/{rel}"
+        name = test_binary_name(import_path)
+        batch = next(
+            (batch for batch in open_batches.get(module, [])
+             if len(batch[2]) < COMPILE_BATCH_SIZE and all(os.path.basename(binary) != name for _, _, binary in batch[2])),
+            None,
+        )
+        if batch is None:
+            output_dir = os.path.join(bin_dir, str(len(batches)))
+            batch = (module, output_dir, [])
+            batches.append(batch)
+            open_batches.setdefault(module, []).append(batch)
+        batch[2].append((dir, import_path, os.path.join(batch[1], name)))
+    return batches
+
+def run_compiled_packages(root, dirs, other_commands, budget, compile_budget, stats, compile_stats, follow_ups):
+    """
+    Two-phase pipeline: test binaries are built per module in batches on one scheduler
+    while the binaries already built are executed under test2json on a second one. Both
+    take their jobs from the same budget.max_jobs slots, compile_budget only caps how many
+    of them builds may hold.
+    Packages whose binary could not be built fall back to a plain go test -json, which
+    reports the build error the same way as the non-pipelined mode. other_commands are
+    run on the execution scheduler as they are.
+    """
+    # Kept out of STATE_DIR, which CI caches between runs
+    bin_dir = tempfile.mkdtemp(prefix="runtests-bin-")
+    batches = plan_compile_batches(root, dirs, bin_dir)
+    compile_feed = closed_feed(
+        (index, f"mkdir -p {output_dir} && cd {root}/{module} && go test -c -p {compile_budget.cpus_per_job} -o {output_dir}/ "
+                + " ".join("./" + os.path.relpath(dir, module) for dir, _, _ in packages))
+        for index, (module, output_dir, packages) in enumerate(batches)
+    )
+    exec_feed = queue.Queue()
+    for command in other_commands:
+        exec_feed.put(command)
+    cancelled = threading.Event()
+    slots = JobSlots(budget.max_jobs)
+
+    def compile_all():
+        try:
+            for index, _, _, _, _ in run_packages(compile_feed, compile_budget, compile_stats, cancelled, slots=slots):
+                for dir, import_path, binary in batches[index][2]:
+                    if os.path.exists(binary):
+                        command = (f"cd {root}/{dir}; go tool test2json -t -p {import_path} {binary} "
+                                   f"-test.v=test2json -test.paniconexit0 -test.timeout=10m0s")
+                    else:
+                        command = f"cd {root}/{dir}; go test -json -p {budget.cpus_per_job}"
+                    exec_feed.put((dir, command))
+        finally:
+            exec_feed.put(None)
+
+    compiler = threading.Thread(target=compile_all, daemon=True)
+    compiler.start()
+    try:
+        yield from run_packages(exec_feed, budget, stats, follow_ups=follow_ups, slots=slots)
+    finally:
+        cancelled.set()
+        compiler.join()
+        shutil.rmtree(bin_dir, ignore_errors=True)
+    print(f"Built test binaries in {len(batches)} batches, {compile_stats['busy_seconds']:.0f}s of compile time, "
+          f"peak {compile_stats['peak_jobs']} builds and {slots.peak} of {budget.max_jobs} workers in total")
+
+def report_utilisation(budget, stats, wall_time, cpu_seconds):
+    if wall_time <= 0:
+        return
+    print(f"Effective utilisation: {100 * cpu_seconds / (wall_time * budget.cpus):.0f}% of {budget.cpus} CPUs "
+          f"({cpu_seconds:.0f} CPU-seconds in {wall_time:.0f}s), "
+          f"average {stats['busy_seconds'] / wall_time:.1f} and peak {stats['peak_jobs']} of {budget.max_jobs} workers, "
+          f"{stats['throttled_polls']} scheduling polls throttled by load or memory")
+    if stats["timed_out"]:
+        print(f"Killed after the {budget.timeout:g}s timeout: {', '.join(sorted(stats['timed_out']))}")
+
+def children_cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+def is_excluded_dir(name):
+    return name.startswith((".", "_")) or name in EXCLUDED_DIRS
+
+def get_directories_with_go_test(root):
+    dirs = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames if not is_excluded_dir(d))
+        if any(name.endswith("_test.go") for name in filenames):
+            dirs.append(os.path.relpath(dirpath, root))
+    return dirs
 
 def runtest_exists(dir):
     return os.path.exists(f"{dir}/runtest.sh")
 
-def run():
-    cpu_count = max(multiprocessing.cpu_count() - 2, 1)
-    print(f"Starting tests on {cpu_count} processes")
+def load_json_state(path, what):
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Ignoring unreadable {what} {path}: {e}")
+        return {}
+
+def save_json_state(path, data):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+def load_durations(path):
+    return load_json_state(path, "duration history")
+
+def save_durations(path, durations, results):
+    for dir, duration in results.items():
+        history = durations.get(dir, []) + [round(duration, 3)]
+        durations[dir] = history[-DURATION_HISTORY_SIZE:]
+    save_json_state(path, durations)
+
+def digest_files(paths, base=None):
+    h = hashlib.sha256()
+    for path in paths:
+        h.update((os.path.relpath(path, base) if base else os.path.basename(path)).encode())
+        try:
+            with open(path, "rb") as f:
+                h.update(f.read())
+        except FileNotFoundError:
+            h.update(b"<missing>")
+    return h.hexdigest()
+
+def read_workspace_modules(root):
+    """ Returns the module directories named by the use directives of go.work. """
+    modules = []
+    in_block = False
+    with open(os.path.join(root, "go.work"), "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.split("//")[0].strip()
+            if in_block:
+                if line == ")":
+                    in_block = False
+                elif line:
+                    modules.append(line)
+            elif line == "use (":
+                in_block = True
+            elif line.startswith("use "):
+                modules.append(line[len("use "):].strip())
+    return [os.path.normpath(module.strip('"')) for module in modules]
+
+def walk_package_dirs(root, top):
+    """
+    Yields the directories below top that hold .go files, skipping what the go tool
+    ignores (testdata, vendor, hidden and _-prefixed directories) and nested modules.
+    """
+    for dirpath, dirnames, filenames in os.walk(os.path.join(root, top)):
+        dirnames[:] = sorted(
+            d for d in dirnames
+            if not is_excluded_dir(d) and not os.path.exists(os.path.join(dirpath, d, "go.mod"))
+        )
+        if any(name.endswith(".go") for name in filenames):
+            yield os.path.relpath(dirpath, root)
+
+def go_sources_digest(root, dir):
+    path = os.path.join(root, dir)
+    return digest_files(sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith(".go")))
+
+def list_go_packages(root, module, patterns):
+    """ Runs go list in a module and returns the imports of each listed package keyed by directory. """
+    cmd = ["go", "list", "-e", "-json=ImportPath,Dir,Imports,TestImports,XTestImports", *patterns]
+    result = subprocess.run(cmd, cwd=os.path.join(root, module), capture_output=True, text=True)
+    if result.returncode != 0:
+        sys.exit(f"go list failed in module {module}:\n{result.stderr}")
+    output = result.stdout
+    decoder = json.JSONDecoder()
+    packages = {}
+    pos = 0
+    while True:
+        while pos < len(output) and output[pos].isspace():
+            pos += 1
+        if pos == len(output):
+            return packages
+        pkg, pos = decoder.raw_decode(output, pos)
+        imports = set(pkg.get("Imports", [])) | set(pkg.get("TestImports", [])) | set(pkg.get("XTestImports", []))
+        packages[os.path.relpath(pkg["Dir"], root)] = {"import_path": pkg["ImportPath"], "imports": sorted(imports)}
+
+def update_module_graph(root, module, cached):
+    """
+    Refreshes the cached packages of one module. Everything is listed again when go.mod
+    or go.sum changed, otherwise only the packages whose .go files changed.
+    """
+    fingerprint = digest_files([os.path.join(root, module, "go.mod"), os.path.join(root, module, "go.sum")])
+    stamps = {dir: go_sources_digest(root, dir) for dir in walk_package_dirs(root, module)}
+    packages = cached["packages"] if cached and cached.get("fingerprint") == fingerprint else {}
+    stale = [dir for dir, stamp in stamps.items() if packages.get(dir, {}).get("stamp") != stamp]
+    packages = {dir: packages[dir] for dir in stamps if dir not in stale and dir in packages}
+    if stale:
+        print(f"Listing {len(stale)} packages of module {module}")
+        patterns = ["./" + os.path.relpath(dir, module) for dir in stale] if packages else ["./..."]
+        listed = list_go_packages(root, module, patterns)
+        for dir in stale:
+            # Directories whose files are all excluded by build constraints are not listed
+            packages[dir] = dict(listed.get(dir, {"import_path": None, "imports": []}), stamp=stamps[dir])
+    return {"fingerprint": fingerprint, "packages": packages}
+
+def load_import_graph(root, path):
+    """ Returns {module dir: {package dir: {import_path, imports, stamp}}} for the go.work modules. """
+    cache = load_json_state(path, "import graph")
+    work_digest = digest_files([os.path.join(root, "go.work")])
+    if cache.get("version") != GRAPH_VERSION or cache.get("go_work") != work_digest:
+        cache = {"modules": {}}
+    modules = {
+        module: update_module_graph(root, module, cache["modules"].get(module))
+        for module in read_workspace_modules(root)
+    }
+    save_json_state(path, {"version": GRAPH_VERSION, "go_work": work_digest, "modules": modules})
+    return {module: data["packages"] for module, data in modules.items()}
+
+def git_changed_files(root, ref):
+    """ Files changed since the merge base with ref, including uncommitted and untracked ones. """
+    def git(*args):
+        return subprocess.run(["git", *args], cwd=root, capture_output=True, text=True, check=True).stdout
+    base = git("merge-base", ref, "HEAD").strip()
+    changed = git("diff", "--name-only", base).splitlines()
+    changed += git("ls-files", "--others", "--exclude-standard").splitlines()
+    return sorted(set(changed))
+
+def get_affected_directories(root, ref, graph, test_dirs):
+    """
+    Returns the test directories whose package, or any package it transitively imports,
+    changed since ref. Returns None when everything has to run.
+    """
+    changed_files = git_changed_files(root, ref)
+    if any(f in ("go.work", "go.work.sum") for f in changed_files):
+        print("go.work changed, every package is affected")
+        return None
+
+    dir_to_import_path = {}
+    for packages in graph.values():
+        for dir, pkg in packages.items():
+            dir_to_import_path[dir] = pkg["import_path"]
+    importers = {}
+    for packages in graph.values():
+        for dir, pkg in packages.items():
+            for imported in pkg["imports"]:
+                importers.setdefault(imported, set()).add(dir)
+
+    changed_dirs = set()
+    for f in changed_files:
+        dir = os.path.dirname(f) or "."
+        if os.path.basename(f) in ("go.mod", "go.sum") and dir in graph:
+            changed_dirs.update(graph[dir])
+            continue
+        if dir in dir_to_import_path or dir in test_dirs:
+            changed_dirs.add(dir)
+            continue
+        # Testdata belongs to the package it sits in
+        parts = dir.split("/")
+        if "testdata" in parts:
+            owner = "/".join(parts[:parts.index("testdata")]) or "."
+            if owner in dir_to_import_path or owner in test_dirs:
+                changed_dirs.add(owner)
+                continue
+        # Any other file may be read by tests anywhere in its module through relative paths,
+        # like the contracts x/evm tests load from ../../contracts
+        module = module_root(root, dir)
+        if module not in graph:
+            print(f"{f} is outside the go.work modules, every package is affected")
+            return None
+        changed_dirs.update(graph[module])
+
+    affected = set(changed_dirs)
+    queue = list(changed_dirs)
+    while queue:
+        import_path = dir_to_import_path.get(queue.pop())
+        for importer in importers.get(import_path, ()):
+            if importer not in affected:
+                affected.add(importer)
+                queue.append(importer)
+    return {dir for dir in test_dirs if dir in affected}
+
+def package_files(root, dir):
+    """ The files of a package directory plus its testdata tree; subdirectories are other packages. """
+    path = os.path.join(root, dir)
+    files = [os.path.join(path, name) for name in sorted(os.listdir(path)) if os.path.isfile(os.path.join(path, name))]
+    for dirpath, dirnames, filenames in os.walk(os.path.join(path, "testdata")):
+        dirnames.sort()
+        files += [os.path.join(dirpath, name) for name in sorted(filenames)]
+    return files
+
+def module_data_files(root, module):
+    """
+    The files of a module that are not package sources: go.mod, go.sum and every non-.go
+    file or testdata file, which tests may read through relative paths such as
+    ../../contracts/wasm or ../keeper/testdata. Nested modules are left to themselves.
+    """
+    files = []
+    for dirpath, dirnames, filenames in os.walk(os.path.join(root, module)):
+        in_testdata = "testdata" in os.path.relpath(dirpath, root).split(os.sep)
+        dirnames[:] = sorted(
+            d for d in dirnames
+            if (d == "testdata" or not is_excluded_dir(d)) and not os.path.exists(os.path.join(dirpath, d, "go.mod"))
+        )
+        files += [os.path.join(dirpath, name) for name in sorted(filenames) if in_testdata or not name.endswith(".go")]
+    return files
+
+def go_environment_digest(root):
+    env = subprocess.run(
+        ["go", "env", "GOVERSION", "GOOS", "GOARCH", "GOFLAGS", "CGO_ENABLED"],
+        cwd=root, capture_output=True, text=True, check=True,
+    ).stdout
+    h = hashlib.sha256(f"v{RESULT_CACHE_VERSION}\n{env}".encode())
+    h.update(digest_files([os.path.join(root, "go.work"), os.path.join(root, "go.work.sum")]).encode())
+    return h.hexdigest()
+
+def compute_package_hashes(root, dirs, graph):
+    """
+    Returns a content hash per test directory covering the sources of the package and of
+    every workspace package it transitively imports, the non-source files of the modules
+    involved (go.mod, go.sum and fixtures), the go toolchain and how the package is run. Directories outside the go.work
+    modules have no known dependencies and are left out, so they always run.
+    """
+    module_of = {}
+    import_path_to_dir = {}
+    for module, packages in graph.items():
+        for dir, pkg in packages.items():
+            module_of[dir] = module
+            import_path_to_dir[pkg["import_path"]] = dir
+
+    env_digest = go_environment_digest(root)
+    source_digests = {}
+    module_digests = {}
+    hashes = {}
+    for dir in dirs:
+        if dir not in module_of:
+            continue
+        closure = {dir}
+        queue = [dir]
+        while queue:
+            current = queue.pop()
+            for imported in graph[module_of[current]][current]["imports"]:
+                dep = import_path_to_dir.get(imported)
+                if dep is not None and dep not in closure:
+                    closure.add(dep)
+                    queue.append(dep)
+
+        h = hashlib.sha256(env_digest.encode())
+        for dep in sorted(closure):
+            if dep not in source_digests:
+                source_digests[dep] = digest_files(package_files(root, dep), os.path.join(root, dep))
+            h.update(f"{dep}:{source_digests[dep]}\n".encode())
+        for module in sorted({module_of[dep] for dep in closure}):
+            if module not in module_digests:
+                module_digests[module] = digest_files(module_data_files(root, module), os.path.join(root, module))
+            h.update(f"{module}:{module_digests[module]}\n".encode())
+        h.update(b"./runtest.sh" if runtest_exists(os.path.join(root, dir)) else b"go test")
+        hashes[dir] = h.hexdigest()
+    return hashes
+
+def result_cache_path(cache_dir, package_hash):
+    return os.path.join(cache_dir, package_hash[:2], f"{package_hash}.json")
+
+def lookup_cached_results(cache_dir, hashes):
+    """ Returns the cache entries of the directories whose hash already passed. """
+    hits = {}
+    for dir, package_hash in hashes.items():
+        entry = load_json_state(result_cache_path(cache_dir, package_hash), "result cache entry")
+        if entry.get("dir") == dir:
+            hits[dir] = entry
+    return hits
+
+def store_cached_result(cache_dir, package_hash, dir, duration):
+    save_json_state(result_cache_path(cache_dir, package_hash), {"dir": dir, "duration": round(duration, 3)})
+
+def estimate_durations(dirs, durations):
+    """
+    Returns the expected duration of each directory. Packages without history are
+    assumed to be as slow as the slowest known one, so they are started early.
+    """
+    known = {dir: statistics.median(durations[dir]) for dir in dirs if durations.get(dir)}
+    default = max(known.values(), default=0.0)
+    return {dir: known.get(dir, default) for dir in dirs}
+
+def schedule_longest_first(dirs, estimates):
+    return sorted(dirs, key=lambda dir: (-estimates[dir], dir))
 
-    dirs = get_directories_with_go_test()
+def predict_critical_path(ordered_dirs, estimates, workers):
+    """
+    Simulates the pool handing packages to whichever worker frees up first and
+    returns the predicted wall time and the packages run by the last worker to finish.
+    """
+    heap = [(0.0, worker) for worker in range(workers)]
+    assigned = [[] for _ in range(workers)]
+    for dir in ordered_dirs:
+        finish, worker = heapq.heappop(heap)
+        assigned[worker].append(dir)
+        heapq.heappush(heap, (finish + estimates[dir], worker))
+    makespan, worker = max(heap)
+    return makespan, assigned[worker]
+
+def write_json_report(path, packages, wall_time):
+    save_json_state(path, {
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "wall_time": round(wall_time, 3),
+        "packages": packages,
+    })
+
+def write_junit_report(path, packages):
+    suites = ET.Element("testsuites")
+    for dir, package in sorted(packages.items()):
+        tests = package.get("tests", {})
+        suite = ET.SubElement(suites, "testsuite", {
+            "name": dir,
+            "tests": str(len(tests)),
+            "failures": str(sum(1 for test in tests.values() if test["status"] == "fail")),
+            "skipped": str(sum(1 for test in tests.values() if test["status"] == "skip")),
+            "time": f"{package['duration']:.3f}",
+        })
+        for name, test in sorted(tests.items()):
+            case = ET.SubElement(suite, "testcase", {"classname": dir, "name": name, "time": f"{test['duration']:.3f}"})
+            if test["status"] == "fail":
+                ET.SubElement(case, "failure", {"message": "failed"}).text = test.get("output", "")
+            elif test["status"] == "skip":
+                ET.SubElement(case, "skipped")
+        # Build failures, runtest.sh packages and crashes outside of a test have no failing test case
+        if package["status"] == "fail" and not any(test["status"] == "fail" for test in tests.values()):
+            case = ET.SubElement(suite, "testcase", {"classname": dir, "name": "(package)", "time": f"{package['duration']:.3f}"})
+            ET.SubElement(case, "failure", {"message": "package failed"}).text = package.get("output", "")
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    ET.ElementTree(suites).write(path, encoding="utf-8", xml_declaration=True)
+
+def test_durations(packages):
+    """ Durations of the top-level tests that passed, keyed by package and test name. """
+    return {
+        f"{dir} {name}": test["duration"]
+        for dir, package in packages.items()
+        for name, test in package.get("tests", {}).items()
+        if "/" not in name and test["status"] == "pass"
+    }
+
+def print_slowest(title, durations, top):
+    if not durations:
+        return
+    print(f"{title}:")
+    for name, duration in sorted(durations.items(), key=lambda item: -item[1])[:top]:
+        print(f"  {duration:9.2f}s  {name}")
+
+def print_timing_diff(title, current, previous, top):
+    """ Prints the largest slowdowns and speedups of what ran in both the current and previous run. """
+    deltas = {
+        name: (previous[name], duration)
+        for name, duration in current.items()
+        if name in previous and abs(duration - previous[name]) >= TIMING_DIFF_MIN_SECONDS
+    }
+    if not deltas:
+        return
+    ordered = sorted(deltas.items(), key=lambda item: item[1][1] - item[1][0])
+    print(f"{title}:")
+    for label, rows in (("slower", reversed(ordered[-top:])), ("faster", ordered[:top])):
+        for name, (before, after) in rows:
+            if (after > before) == (label == "slower"):
+                change = f"{100 * (after - before) / before:+.0f}%" if before else "new"
+                print(f"  {label} {before:8.2f}s -> {after:8.2f}s ({change})  {name}")
+
+def report_timings(packages, previous, top):
+    package_durations = {dir: package["duration"] for dir, package in packages.items() if package["status"] in ("pass", "fail")}
+    print_slowest(f"Slowest {top} packages", package_durations, top)
+    print_slowest(f"Slowest {top} tests", test_durations(packages), top)
+    if previous.get("packages"):
+        previous_packages = previous["packages"]
+        print_timing_diff(
+            f"Package timings vs previous run ({previous.get('created', 'unknown')})",
+            package_durations,
+            {dir: package["duration"] for dir, package in previous_packages.items() if package["status"] in ("pass", "fail")},
+            top,
+        )
+        print_timing_diff("Test timings vs previous run", test_durations(packages), test_durations(previous_packages), top)
+
+def parse_benchmark_output(lines, samples):
+    """
+    Echoes go test -bench output and appends every measurement to
+    samples[(package, benchmark, unit)]. The -GOMAXPROCS suffix is dropped from names
+    so results from differently sized machines stay comparable.
+    """
+    package = None
+    for line in lines:
+        print(line, end="", flush=True)
+        if line.startswith("pkg: "):
+            package = line[len("pkg: "):].strip()
+            continue
+        match = BENCH_LINE.match(line.strip())
+        if match is None:
+            continue
+        name, metrics = match.groups()
+        for value, unit in BENCH_METRIC.findall(metrics):
+            samples.setdefault((package, name, unit), []).append(float(value))
+
+def run_benchmarks(root, patterns, bench_filter, count):
+    """ Runs the benchmarks one package pattern at a time so they do not disturb each other. """
+    samples = {}
+    success = True
+    for pattern in patterns:
+        base = pattern.split("/...")[0]
+        module = module_root(root, base)
+        target = "./" + os.path.relpath(os.path.join(root, pattern), os.path.join(root, module))
+        cmd = ["go", "test", "-run", "^$", "-bench", bench_filter, "-benchmem", "-count", str(count), target]
+        print(f"Running {' '.join(cmd)} in {module}", flush=True)
+        proc = subprocess.Popen(cmd, cwd=os.path.join(root, module), stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        parse_benchmark_output(proc.stdout, samples)
+        if proc.wait() != 0:
+            success = False
+    return samples, success
+
+def open_bench_db(path):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    db = sqlite3.connect(path)
+    db.executescript("""
+        CREATE TABLE IF NOT EXISTS runs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            created TEXT NOT NULL,
+            git_rev TEXT,
+            label TEXT
+        );
+        CREATE TABLE IF NOT EXISTS samples (
+            run_id INTEGER NOT NULL REFERENCES runs(id),
+            package TEXT NOT NULL,
+            benchmark TEXT NOT NULL,
+            unit TEXT NOT NULL,
+            value REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS samples_by_run ON samples(run_id);
+    """)
+    return db
+
+def store_benchmark_run(db, samples, git_rev, label):
+    with db:
+        run_id = db.execute(
+            "INSERT INTO runs (created, git_rev, label) VALUES (?, ?, ?)",
+            (datetime.now(timezone.utc).isoformat(timespec="seconds"), git_rev, label),
+        ).lastrowid
+        db.executemany(
+            "INSERT INTO samples (run_id, package, benchmark, unit, value) VALUES (?, ?, ?, ?, ?)",
+            [(run_id, package, name, unit, value) for (package, name, unit), values in samples.items() for value in values],
+        )
+    return run_id
+
+def find_baseline_run(db, run_id, baseline):
+    """
+    Resolves --bench-baseline: a run id, a label, a git revision (prefix), or by default
+    the latest run before this one. Returns (id, description) or None.
+    """
+    query = "SELECT id, created, git_rev, label FROM runs WHERE id < ? "
+    if baseline is None:
+        row = db.execute(query + "ORDER BY id DESC LIMIT 1", (run_id,)).fetchone()
+    else:
+        row = db.execute(
+            query + "AND (CAST(id AS TEXT) = ? OR label = ? OR git_rev LIKE ?) ORDER BY id DESC LIMIT 1",
+            (run_id, baseline, baseline, f"{baseline}%"),
+        ).fetchone()
+    if row is None:
+        return None
+    id, created, git_rev, label = row
+    return id, f"run {id} from {created} at {(git_rev or 'unknown')[:12]}" + (f" ({label})" if label else "")
+
+def load_benchmark_run(db, run_id):
+    samples = {}
+    for package, name, unit, value in db.execute(
+            "SELECT package, benchmark, unit, value FROM samples WHERE run_id = ?", (run_id,)):
+        samples.setdefault((package, name, unit), []).append(value)
+    return samples
+
+@functools.lru_cache(maxsize=None)
+def count_u_statistics(n1, n2, u):
+    """ Number of orderings of n1 + n2 distinct values whose Mann-Whitney U equals u. """
+    if u < 0 or u > n1 * n2:
+        return 0
+    if n1 == 0 or n2 == 0:
+        return 1 if u == 0 else 0
+    return count_u_statistics(n1 - 1, n2, u - n2) + count_u_statistics(n1, n2 - 1, u)
+
+def mann_whitney_p_value(xs, ys):
+    """
+    Two-sided p-value of the Mann-Whitney U test, the test benchstat uses. The exact
+    distribution is used for small samples without ties, otherwise the normal
+    approximation with tie and continuity correction.
+    """
+    n1, n2 = len(xs), len(ys)
+    values = sorted(xs + ys)
+    ranks = {}
+    tie_term = 0
+    i = 0
+    while i < len(values):
+        j = i
+        while j < len(values) and values[j] == values[i]:
+            j += 1
+        ranks[values[i]] = (i + j + 1) / 2
+        tie_term += (j - i) ** 3 - (j - i)
+        i = j
+    u1 = sum(ranks[x] for x in xs) - n1 * (n1 + 1) / 2
+    u = min(u1, n1 * n2 - u1)
+
+    if tie_term == 0 and max(n1, n2) <= BENCH_EXACT_MAX_SAMPLES:
+        tail = sum(count_u_statistics(n1, n2, k) for k in range(int(u) + 1))
+        return min(1.0, 2 * tail / math.comb(n1 + n2, n1))
+    n = n1 + n2
+    variance = n1 * n2 / 12 * ((n + 1) - tie_term / (n * (n - 1)))
+    if variance <= 0:
+        return 1.0
+    z = (n1 * n2 / 2 - u - 0.5) / math.sqrt(variance)
+    return min(1.0, math.erfc(max(z, 0.0) / math.sqrt(2)))
+
+def compare_benchmarks(baseline, current, threshold):
+    """
+    Returns one row per (package, benchmark, unit) of BENCH_COMPARED_UNITS measured in both
+    runs. These are lower-is-better; a row is a regression when the median grew by at least
+    threshold percent and the difference is significant.
+    """
+    rows = []
+    for key in sorted(key for key in set(baseline) & set(current) if key[2] in BENCH_COMPARED_UNITS):
+        before, after = statistics.median(baseline[key]), statistics.median(current[key])
+        p_value = mann_whitney_p_value(baseline[key], current[key])
+        delta = 100 * (after - before) / before if before else 0.0
+        significant = p_value < BENCH_ALPHA
+        rows.append({
+            "key": key,
+            "before": before,
+            "after": after,
+            "delta": delta,
+            "p_value": p_value,
+            "significant": significant,
+            "regression": significant and delta >= threshold,
+        })
+    return rows
+
+def print_benchmark_comparison(rows):
+    print(f"{'benchmark':<60} {'unit':>10} {'baseline':>14} {'current':>14} {'delta':>8} {'p':>6}")
+    current_package = None
+    for row in rows:
+        package, name, unit = row["key"]
+        if package != current_package:
+            print(f"pkg: {package}")
+            current_package = package
+        delta = f"{row['delta']:+.1f}%" if row["significant"] else "~"
+        marker = "  REGRESSION" if row["regression"] else ""
+        print(f"{name:<60} {unit:>10} {row['before']:>14.6g} {row['after']:>14.6g} {delta:>8} {row['p_value']:>6.3f}{marker}")
+
+def bench(root, args):
+    samples, success = run_benchmarks(root, args.bench_packages or DEFAULT_BENCH_PACKAGES, args.bench_filter, args.bench_count)
+    if not success:
+        print("benchmarks failed, results are not recorded")
+        sys.exit(1)
+    if not samples:
+        print("no benchmark results found")
+        return
+
+    db = open_bench_db(args.bench_db or os.path.join(root, BENCH_DB_FILE))
+    git_rev = subprocess.run(["git", "rev-parse", "HEAD"], cwd=root, capture_output=True, text=True).stdout.strip()
+    run_id = store_benchmark_run(db, samples, git_rev or None, args.bench_label)
+    print(f"Recorded benchmark run {run_id}")
+    baseline = find_baseline_run(db, run_id, args.bench_baseline)
+    if baseline is None:
+        print("No baseline run to compare against")
+        return
+
+    baseline_id, description = baseline
+    print(f"Comparing against {description}")
+    rows = compare_benchmarks(load_benchmark_run(db, baseline_id), samples, args.bench_threshold)
+    print_benchmark_comparison(rows)
+    regressions = [row for row in rows if row["regression"]]
+    if regressions:
+        print(f"{len(regressions)} significant regressions of at least {args.bench_threshold:g}%")
+        sys.exit(1)
+    print("no significant regressions")
+
+def failed_top_level_tests(tests, ever=False):
+    """ Top-level tests that failed, or with ever=True that failed in any attempt. """
+    return sorted(
+        name for name, test in tests.items()
+        if "/" not in name and (test["status"] == "fail" or (ever and test.get("failed_attempts")))
+    )
+
+def retry_command(root, dir, test_names, budget):
+    pattern = "^(" + "|".join(re.escape(name) for name in test_names) + ")$"
+    return f"cd {root}/{dir}; go test -json -p {budget.cpus_per_job} -count=1 -run '{pattern}'"
+
+def merge_retried_tests(tests, retried):
+    """ Replaces the results of retried tests, counting how often each of them failed before. """
+    for name, test in retried.items():
+        previous = tests.get(name, {})
+        failed_attempts = previous.get("failed_attempts", 0) + (previous.get("status") == "fail")
+        tests[name] = dict(test, failed_attempts=failed_attempts)
+
+def is_quarantined(flakes, key, min_rate):
+    """ A test is known to be flaky once it flaked repeatedly and in at least min_rate of its runs. """
+    entry = flakes.get(key)
+    return (
+        entry is not None and entry["flakes"] >= QUARANTINE_MIN_FLAKES
+        and entry["flakes"] / entry["runs"] >= min_rate
+    )
+
+def update_flake_statistics(flakes, report):
+    for dir, package in report.items():
+        for name, test in package.get("tests", {}).items():
+            if "/" in name:
+                continue
+            entry = flakes.setdefault(f"{dir} {name}", {"runs": 0, "failures": 0, "flakes": 0})
+            entry["runs"] += 1
+            if test["status"] == "fail" or test.get("failed_attempts"):
+                entry["failures"] += 1
+            if test["status"] == "pass" and test.get("failed_attempts"):
+                entry["flakes"] += 1
+
+def report_flaky_tests(flakes, flaky, quarantined):
+    def describe(dir, name):
+        entry = flakes.get(f"{dir} {name}", {"runs": 0, "flakes": 0})
+        return f"  {dir} {name} (flaked in {entry['flakes']} of {entry['runs']} runs)"
+    if flaky:
+        print("Flaky tests (failed, then passed on retry):")
+        for dir, name in flaky:
+            print(describe(dir, name))
+    if quarantined:
+        print("Quarantined tests (known flaky, failures do not fail the run):")
+        for dir, name in quarantined:
+            print(describe(dir, name))
+
+def parse_shard(value):
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected i/N, got {value!r}")
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(f"shard index must be between 1 and {count}, got {index}")
+    return index, count
+
+def partition_into_shards(dirs, estimates, count):
+    """
+    Splits the packages into count shards of about equal expected runtime by handing
+    each package, longest first, to the shard with the least work so far. Every shard
+    has to see the same duration history for the partitions to line up.
+    """
+    loads = [(0.0, shard) for shard in range(count)]
+    shards = [[] for _ in range(count)]
+    for dir in schedule_longest_first(dirs, estimates):
+        load, shard = heapq.heappop(loads)
+        shards[shard].append(dir)
+        heapq.heappush(loads, (load + estimates[dir], shard))
+    return shards
+
+def write_results_file(path, shard, all_dirs, results, wall_time):
+    save_json_state(path, {
+        "shard": list(shard),
+        "packages_digest": hashlib.sha256("\n".join(sorted(all_dirs)).encode()).hexdigest(),
+        "assigned": sorted(results),
+        "results": results,
+        "wall_time": round(wall_time, 3),
+    })
+
+def merge_results(paths, durations_file):
+    """
+    Combines the results files of every shard into one verdict and folds the measured
+    durations into the history so that the next partition is balanced on all of them.
+    """
+    shards = [load_json_state(path, "results file") for path in paths]
+    problems = []
+    if len({shard.get("packages_digest") for shard in shards}) > 1:
+        problems.append("shards were partitioned from different package sets")
+    seen = sorted(tuple(shard.get("shard", (1, 1))) for shard in shards)
+    count = seen[-1][1]
+    if seen != [(index, count) for index in range(1, count + 1)]:
+        problems.append(f"expected one results file for each of {count} shards, got {seen}")
+
+    results = {}
+    for path, shard in zip(paths, shards):
+        index, count = shard.get("shard") or (1, 1)
+        failures = sum(1 for result in shard.get("results", {}).values() if result["status"] == "fail")
+        print(f"Shard {index}/{count}: {len(shard.get('assigned', []))} packages, "
+              f"{failures} failed, {shard.get('wall_time', 0):.1f}s ({path})")
+        for dir, result in shard.get("results", {}).items():
+            if dir in results:
+                problems.append(f"{dir} was run by more than one shard")
+            results[dir] = result
+    not_run = sorted(dir for shard in shards for dir in shard.get("assigned", []) if results[dir]["status"] == "not run")
+    failed = sorted(dir for dir, result in results.items() if result["status"] == "fail")
+
+    durations = load_durations(durations_file)
+    save_durations(durations_file, durations, {
+        dir: result["duration"] for dir, result in results.items() if result["status"] in ("pass", "fail")
+    })
+
+    for problem in problems:
+        print(f"Merge problem: {problem}")
+    if not_run:
+        print(f"{len(not_run)} packages were not run:")
+        for dir in not_run:
+            print(f"  {dir}")
+    if failed:
+        print("Failed packages:")
+        for dir in failed:
+            print(f"  {dir}")
+    if problems or not_run or failed:
+        print("test failed")
+        sys.exit(1)
+    print(f"test success ({len(results)} packages across {len(shards)} shards)")
+
+def run():
+    parser = argparse.ArgumentParser(description="Run the go tests of every package in parallel")
+    parser.add_argument(
+        '--durations-file',
+        help=f'Per-package duration history used for scheduling (default: {DURATIONS_FILE})',
+        default=None,
+    )
+    parser.add_argument(
+        '--fail-fast',
+        help='Cancel the remaining packages as soon as one of them fails',
+        action='store_true',
+    )
+    parser.add_argument(
+        '--since',
+        metavar='GIT_REF',
+        help='Only run packages affected by changes since the merge base with this git ref',
+        default=None,
+    )
+    parser.add_argument(
+        '--graph-file',
+        help=f'Cached import graph used by --since and --cache-dir (default: {GRAPH_FILE})',
+        default=None,
+    )
+    parser.add_argument(
+        '--cache-dir',
+        help='Skip packages whose content hash already passed and record new passes in this directory',
+        default=None,
+    )
+    parser.add_argument(
+        '--shard',
+        metavar='i/N',
+        help='Only run the i-th of N runtime-balanced partitions of the packages (1-based)',
+        type=parse_shard,
+        default=None,
+    )
+    parser.add_argument(
+        '--results-file',
+        help='Write a mergeable JSON summary of this run (or shard) to this file',
+        default=None,
+    )
+    parser.add_argument(
+        '--merge',
+        metavar='RESULTS_FILE',
+        nargs='+',
+        help='Combine the results files of all shards into one verdict instead of running tests',
+        default=None,
+    )
+    parser.add_argument(
+        '--report-file',
+        help=f'JSON report with per-package and per-test durations; the previous one is diffed against (default: {REPORT_FILE})',
+        default=None,
+    )
+    parser.add_argument(
+        '--junit-file',
+        help='Also write a JUnit XML report to this file',
+        default=None,
+    )
+    parser.add_argument(
+        '--top',
+        help='Number of rows in the slowest tests and timing diff tables',
+        type=int,
+        default=10,
+    )
+    parser.add_argument(
+        '--cpus-per-job',
+        help='GOMAXPROCS and build parallelism (-p) of each package',
+        type=int,
+        default=2,
+    )
+    parser.add_argument(
+        '--jobs',
+        help='Maximum number of packages run at once (default: CPUs / --cpus-per-job)',
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        '--memory-per-job',
+        help='GiB of available memory required before another package is started',
+        type=float,
+        default=2.0,
+    )
+    parser.add_argument(
+        '--timeout',
+        help='Seconds after which a package is killed and counted as failed',
+        type=float,
+        default=30 * 60,
+    )
+    parser.add_argument(
+        '--compile-first',
+        help='Build test binaries in batches per go module and run them on a second worker pool as they become ready',
+        action='store_true',
+    )
+    parser.add_argument(
+        '--compile-jobs',
+        help='Maximum number of concurrent go test -c batches with --compile-first, out of --jobs (default: half of --jobs)',
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        '--retries',
+        help='Re-run only the failed tests of a failed package up to this many times',
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        '--flakes-file',
+        help=f'Per-test flake statistics (default: {FLAKES_FILE})',
+        default=None,
+    )
+    parser.add_argument(
+        '--quarantine-rate',
+        help=f'Flake rate from which a test with at least {QUARANTINE_MIN_FLAKES} flakes is quarantined',
+        type=float,
+        default=0.05,
+    )
+    parser.add_argument(
+        '--bench',
+        help='Run benchmarks instead of tests, record them and fail on significant regressions against a baseline',
+        action='store_true',
+    )
+    parser.add_argument(
+        '--bench-packages',
+        metavar='PATTERN',
+        nargs='+',
+        help=f'Package patterns to benchmark (default: {" ".join(DEFAULT_BENCH_PACKAGES)})',
+        default=None,
+    )
+    parser.add_argument(
+        '--bench-filter',
+        help='Regular expression passed to go test -bench',
+        default='.',
+    )
+    parser.add_argument(
+        '--bench-count',
+        help='Samples per benchmark (go test -count)',
+        type=int,
+        default=6,
+    )
+    parser.add_argument(
+        '--bench-db',
+        help=f'SQLite benchmark history (default: {BENCH_DB_FILE})',
+        default=None,
+    )
+    parser.add_argument(
+        '--bench-label',
+        help='Label stored with this benchmark run, e.g. main',
+        default=None,
+    )
+    parser.add_argument(
+        '--bench-baseline',
+        help='Run id, label or git revision to compare against (default: the previous run)',
+        default=None,
+    )
+    parser.add_argument(
+        '--bench-threshold',
+        help='Minimum slowdown in percent for a significant change to count as a regression',
+        type=float,
+        default=5.0,
+    )
+    args = parser.parse_args()
 
     root = os.path.dirname(os.path.abspath(__file__))
-    pool = multiprocessing.Pool(cpu_count)
-    commands = []
-    results = []
+    durations_file = args.durations_file or os.path.join(root, DURATIONS_FILE)
+    if args.merge:
+        merge_results(args.merge, durations_file)
+        return
+    if args.bench:
+        bench(root, args)
+        return
+
+    start = time.monotonic()
+    cpu_seconds_at_start = children_cpu_seconds()
+    cpus = usable_cpus()
+    cpus_per_job = max(1, min(args.cpus_per_job, cpus))
+    budget = WorkerBudget(
+        cpus=cpus,
+        cpus_per_job=cpus_per_job,
+        memory_per_job=int(args.memory_per_job * 1024 ** 3),
+        max_jobs=args.jobs or max(1, cpus // cpus_per_job),
+        timeout=args.timeout,
+    )
+    print(f"Starting tests on up to {budget.max_jobs} workers with {cpus_per_job} CPUs each "
+          f"(GOMAXPROCS={cpus_per_job}, -p {cpus_per_job}) on {cpus} CPUs")
+    durations = load_durations(durations_file)
+
+    dirs = get_directories_with_go_test(root)
+    graph = None
+    if args.since or args.cache_dir:
+        graph = load_import_graph(root, args.graph_file or os.path.join(root, GRAPH_FILE))
+    if args.since:
+        affected = get_affected_directories(root, args.since, graph, set(dirs))
+        if affected is not None:
+            print(f"{len(affected)} of {len(dirs)} packages affected by changes since {args.since}")
+            dirs = [dir for dir in dirs if dir in affected]
+    all_dirs = dirs
+    estimates = estimate_durations(dirs, durations)
+    if args.shard:
+        index, count = args.shard
+        dirs = partition_into_shards(dirs, estimates, count)[index - 1]
+        print(f"Shard {index}/{count}: {len(dirs)} of {len(all_dirs)} packages, "
+              f"~{sum(estimates[dir] for dir in dirs):.1f}s of recorded test time")
+    # Every package this run is responsible for, including cache hits and cancelled ones
+    results = {dir: {"status": "not run", "duration": 0.0} for dir in dirs}
+    hashes = {}
+    if args.cache_dir:
+        hashes = compute_package_hashes(root, dirs, graph)
+        hits = lookup_cached_results(args.cache_dir, hashes)
+        saved = sum(entry["duration"] for entry in hits.values())
+        hit_rate = 100 * len(hits) / len(dirs) if dirs else 0
+        print(f"Result cache: {len(hits)} hits, {len(dirs) - len(hits)} misses ({hit_rate:.0f}% hit rate), "
+              f"saving ~{saved:.1f}s of test time")
+        for dir, entry in hits.items():
+            results[dir] = {"status": "cached", "duration": entry["duration"]}
+        dirs = [dir for dir in dirs if dir not in hits]
+    dirs = schedule_longest_first(dirs, estimates)
+    if durations and dirs:
+        makespan, critical_path = predict_critical_path(dirs, estimates, budget.max_jobs)
+        print(f"Predicted wall time: {makespan:.1f}s")
+        print("Predicted critical path: " + " -> ".join(f"{dir} ({estimates[dir]:.1f}s)" for dir in critical_path))
 
+    commands = []
     for dir in dirs:
-        if runtest_exists(dir):
+        if runtest_exists(os.path.join(root, dir)):
             command = f"cd {root}/{dir}; ./runtest.sh"
         else:
-            command = f"cd {root}/{dir}; go test"
-        commands.append(command)
+            command = f"cd {root}/{dir}; go test -json -p {budget.cpus_per_job}"
+        commands.append((dir, command))
 
-    results = pool.map(call_proc, commands)
-    success = True
-    for dir, result in zip(dirs, results):
-        print(dir)
-        print(result)
-        if "FAIL" in result:
-            success = False
+    completed = {}
+    failed = []
+    report = {}
+    flakes_file = args.flakes_file or os.path.join(root, FLAKES_FILE)
+    flakes = load_json_state(flakes_file, "flake statistics")
+    # Retries of failed tests, run by the scheduler ahead of the remaining packages
+    follow_ups = deque()
+    attempts = {}
+    finished = 0
+    flaky = []
+    quarantined = []
+    stats = new_scheduler_stats()
+    if args.compile_first:
+        # Packages with their own runtest.sh keep running it
+        compiled = [dir for dir in dirs if not runtest_exists(os.path.join(root, dir))]
+        compile_budget = replace(budget, max_jobs=args.compile_jobs or max(1, budget.max_jobs // 2))
+        jobs = run_compiled_packages(
+            root, compiled, [command for command in commands if command[0] not in compiled],
+            budget, compile_budget, stats, new_scheduler_stats(), follow_ups,
+        )
+    else:
+        jobs = run_packages(closed_feed(commands), budget, stats, follow_ups=follow_ups)
+    try:
+        # Results are printed as soon as each package finishes and only its status is kept,
+        # so memory stays flat regardless of how much output the suite produces.
+        for dir, returncode, output, tests, duration in jobs:
+            attempt = attempts.get(dir, 0)
+            if attempt == 0:
+                completed[dir] = duration
+                report[dir] = {"tests": tests}
+            else:
+                merge_retried_tests(report[dir]["tests"], tests)
+            failed_tests = failed_top_level_tests(tests)
+            if returncode != 0 and failed_tests and attempt < args.retries:
+                attempts[dir] = attempt + 1
+                print(f"{dir} (FAIL {duration:.1f}s, retrying {' '.join(failed_tests)}, attempt {attempt + 1}/{args.retries})")
+                print(output, flush=True)
+                follow_ups.append((dir, retry_command(root, dir, failed_tests, budget)))
+                continue
+
+            package_tests = report[dir]["tests"]
+            package_flaky = [name for name in failed_top_level_tests(package_tests, ever=True)
+                             if package_tests[name]["status"] == "pass"]
+            package_quarantined = []
+            if returncode != 0:
+                still_failing = failed_top_level_tests(package_tests)
+                if still_failing and all(is_quarantined(flakes, f"{dir} {name}", args.quarantine_rate) for name in still_failing):
+                    package_quarantined = still_failing
+            passed = returncode == 0 or bool(package_quarantined)
+            flaky += [(dir, name) for name in package_flaky]
+            quarantined += [(dir, name) for name in package_quarantined]
+
+            results[dir] = {"status": "pass" if passed else "fail", "duration": round(completed[dir], 3)}
+            report[dir].update(results[dir], flaky=package_flaky, quarantined=package_quarantined)
+            if not passed:
+                report[dir]["output"] = output
+            status = "ok" if returncode == 0 else "ok, quarantined" if passed else "FAIL"
+            if package_flaky:
+                status += ", flaky"
+            finished += 1
+            print(f"{dir} ({status} {completed[dir]:.1f}s, {finished}/{len(dirs)})")
+            print(output, flush=True)
+            if returncode == 0 and dir in hashes:
+                store_cached_result(args.cache_dir, hashes[dir], dir, completed[dir])
+            if not passed:
+                failed.append(dir)
+                if args.fail_fast:
+                    print(f"Cancelling {len(dirs) - finished} remaining packages (--fail-fast)")
+                    break
+    finally:
+        jobs.close()
+    for dir in attempts:
+        if results[dir]["status"] == "not run":
+            # The retry of a failed test was still pending when --fail-fast cancelled the run
+            results[dir] = {"status": "fail", "duration": round(completed[dir], 3)}
+            report[dir].update(results[dir], flaky=[], quarantined=[],
+                               output="runtests.py: retry cancelled by --fail-fast\n")
+            failed.append(dir)
+
+    save_durations(durations_file, durations, completed)
+    wall_time = time.monotonic() - start
+    report_utilisation(budget, stats, wall_time, children_cpu_seconds() - cpu_seconds_at_start)
+    if args.results_file:
+        write_results_file(args.results_file, args.shard or (1, 1), all_dirs, results, wall_time)
+
+    report_file = args.report_file or os.path.join(root, REPORT_FILE)
+    previous_report = load_json_state(report_file, "previous report")
+    for dir, result in results.items():
+        entry = report.setdefault(dir, {"tests": {}})
+        for key, value in result.items():
+            entry.setdefault(key, value)
+    report_timings(report, previous_report, args.top)
+    write_json_report(report_file, report, wall_time)
+    if args.junit_file:
+        write_junit_report(args.junit_file, report)
+
+    update_flake_statistics(flakes, report)
+    save_json_state(flakes_file, flakes)
+    report_flaky_tests(flakes, flaky, quarantined)
 
-    if success:
+    if not failed:
         print("test success")
     else:
+        print("Failed packages:")
+        for dir in failed:
+            print(f"  {dir}")
         print("test failed")
         sys.exit(1)
 